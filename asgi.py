@@ -0,0 +1,273 @@
+'''
+asgi entry point, run with an asgi server:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+reads that only wait on docker (list, get, status, log, stream) are served
+on the event loop, every other route goes to the wsgi app on a thread pool
+'''
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+import asyncio
+import io
+import json
+import re
+import sys
+import time
+
+import view
+from auth import verify_token
+from config import get_config, get_config_int
+from core.asyncmanager import AsyncNgrokManager
+from core.error import TunnelManagerError
+
+
+ANM = AsyncNgrokManager(view.NM, get_config('basic', 'docker_url'))
+# mutations hold a thread for the stop grace period, wait= or a bulk
+# action, keep them off the threads of the async reads
+WSGI_POOL = ThreadPoolExecutor(max_workers=16)
+
+NOT_AUTHORIZED = {"error": 401, "msg": "401 Not Authorized", "data": None}
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, data, status=200):
+    body = json.dumps(data).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*')
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def tunnels(args):
+    return {'data': await ANM.list(), 'error': 0}
+
+
+async def tunnel(args, id):
+    try:
+        return {'data': await ANM.get(id), 'error': 0}
+    except TunnelManagerError as e:
+        return {'data': None, 'error': 1, 'msg': e.message}
+
+
+async def tunnel_status(args, id):
+    try:
+        result = await ANM.status(id)
+        if result:
+            return {'data': result, 'error': 0}
+        return {'data': result, 'error': 1, 'msg': 'tunnel does not running'}
+    except TunnelManagerError as e:
+        return {'data': None, 'error': 1, 'msg': e.message}
+
+
+async def tunnel_log(args, id):
+    try:
+        cursor = args.get('cursor', [''])[0]
+        offset = int(args.get('offset', [0])[0])
+        limit = int(args.get('limit', [10])[0])
+        limit = min(limit, get_config_int('basic', 'log_max_limit', 5000))
+        tail = args.get('tail', [''])[0]
+        tail = int(tail) if tail else None
+        result = await ANM.log(id, cursor=cursor, offset=offset, limit=limit, tail=tail)
+        return {'data': result, 'error': 0}
+    except ValueError:
+        return {'data': None, 'error': 1, 'msg': 'offset, limit and tail must be integers'}
+    except TunnelManagerError as e:
+        return {'data': None, 'error': 1, 'msg': e.message}
+
+
+routes = [
+    ("/api/tunnels", tunnels),
+    ("/api/tunnels/([0-9]+)", tunnel),
+    ("/api/tunnels/([0-9]+)/status", tunnel_status),
+    ("/api/tunnels/([0-9]+)/log", tunnel_log)
+]
+
+
+async def wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def tunnel_stream(receive, send, args, id):
+    '''
+    same events as view.tunnel_stream, without holding a thread per client
+    '''
+    fmt = args.get('format', ['sse'])[0]
+    if not verify_token(args.get('token', [''])[0]):
+        return await send_json(send, {'data': None, 'error': 401, 'msg': '401 Not Authorized'})
+
+    if id is None:
+        ids = view.stream_ids(args)
+        if not ids:
+            return await send_json(send, {'data': None, 'error': 1, 'msg': 'need ids'})
+        events = ANM.stream_many(ids)
+    else:
+        events = ANM.stream(id)
+    try:
+        first = await events.__anext__()
+    except TunnelManagerError as e:
+        return await send_json(send, {'data': None, 'error': 1, 'msg': e.message})
+
+    if fmt == 'jsonl':
+        content_type = b'application/x-ndjson'
+    else:
+        content_type = b'text/event-stream'
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', content_type),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+            (b'access-control-allow-origin', b'*')
+        ]
+    })
+
+    async def pump():
+        await send({'type': 'http.response.body',
+                    'body': view.format_event(fmt, *first), 'more_body': True})
+        async for event, data in events:
+            await send({'type': 'http.response.body',
+                        'body': view.format_event(fmt, event, data), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    # a server may drop the writes to a gone client without raising,
+    # stop following the log once it says the client left
+    sender = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await asyncio.wait([sender, watcher], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        sender.cancel()
+        # the generator can only be closed once the sender left it
+        await asyncio.gather(watcher, sender, return_exceptions=True)
+        await events.aclose()
+
+
+def wsgi_environ(scope, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/{0}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body))
+    }
+    server = scope.get('server') or ('localhost', 5000)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'content-length':
+            continue
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def call_wsgi(environ):
+    '''
+    run view.application to completion, return status, headers and body
+    '''
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                               for k, v in headers]
+
+    result = view.application(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+
+async def wsgi(scope, receive, send):
+    body = await read_body(receive)
+    loop = asyncio.get_event_loop()
+    status, headers, body = await loop.run_in_executor(
+        WSGI_POOL, call_wsgi, wsgi_environ(scope, body))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            ANM.executor.shutdown(wait=False)
+            WSGI_POOL.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    path, method = scope['path'], scope['method']
+    if method != 'GET':
+        return await wsgi(scope, receive, send)
+
+    args = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    matched = re.match(r'^/api/tunnels/([0-9]+)/stream$', path)
+    if matched:
+        return await tunnel_stream(receive, send, args, matched.group(1))
+    if path == '/api/tunnels/stream':
+        return await tunnel_stream(receive, send, args, None)
+
+    for pattern, handler in routes:
+        matched = re.match('^' + pattern + '$', path)
+        if matched:
+            break
+    else:
+        return await wsgi(scope, receive, send)
+
+    begin = time.time()
+    if verify_token(args.get('token', [''])[0]):
+        result = await handler(args, *matched.groups())
+    else:
+        result = NOT_AUTHORIZED
+    await send_json(send, result)
+
+    labels = {'route': view.route_of(path), 'method': method}
+    view.METRICS.observe('ngrok_webapi_request_duration_seconds', labels, time.time() - begin)
+    labels['code'] = '200'
+    view.METRICS.inc('ngrok_webapi_requests_total', labels)
@@ -1,5 +1,9 @@
 from pycnic.errors import HTTPError
 from functools import wraps
+import hmac
+import os
+import threading
+import time
 
 from model import Auth
 
@@ -31,28 +35,81 @@ def requires_auth():
         return wrapped
     return wrapper
 
-def verify_auth(request):
-    if Auth.select().count() > 0:
-        token = request.args.get('token', '')
+
+class TokenCache:
+    '''
+    auth token held in memory, shared invalidation through a generation file
+    '''
+
+    # seconds between two generation checks
+    check_interval = 1
+
+    def __init__(self, generation_path):
+        self.generation_path = generation_path
+        self.token = None
+        self.generation = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def read_generation(self):
         try:
-            auth = Auth.get(Auth.id == 1)
-            return auth.token == token
-        except:
-            return False
-    else:
+            return os.stat(self.generation_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self):
+        now = time.time()
+        if self.token is not None and now - self.checked < self.check_interval:
+            return self.token
+
+        with self.lock:
+            self.checked = now
+            generation = self.read_generation()
+            if self.token is None or generation != self.generation:
+                try:
+                    self.token = Auth.get(Auth.id == 1).token
+                except Auth.DoesNotExist:
+                    self.token = None
+                self.generation = generation
+        return self.token
+
+    def set(self, token):
+        '''
+        store a rotated token and tell the other workers
+        '''
+        with self.lock:
+            with open(self.generation_path, 'w') as f:
+                f.write(str(time.time()))
+            self.token = token
+            self.generation = self.read_generation()
+            self.checked = time.time()
+
+
+TOKEN = TokenCache('data/auth.generation')
+
+
+def compare_token(token, expected):
+    if not expected:
         return False
+    return hmac.compare_digest(token.encode(), expected.encode())
+
+
+def verify_auth(request):
+    return verify_token(request.args.get('token', ''))
+
+
+def verify_token(token):
+    return compare_token(token, TOKEN.get())
+
 
 def change_auth(old_token, new_token):
-    if Auth.select().count() > 0:
-        try:
-            auth = Auth.get(Auth.id == 1)
-            if auth.token == old_token:
-                auth.token = new_token
-                auth.save()
-                return True
-            else:
-                return False
-        except:
-            return False
-    else:
+    if not compare_token(old_token, TOKEN.get()):
+        return False
+    try:
+        auth = Auth.get(Auth.id == 1)
+        auth.token = new_token
+        auth.save()
+        TOKEN.set(new_token)
+        return True
+    except:
         return False
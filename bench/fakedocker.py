@@ -0,0 +1,214 @@
+import re
+import threading
+import time
+import uuid
+import yaml
+
+
+class FakeLogStream:
+    '''
+    a followed log, lines come when they are due until the container
+    stops or the stream is closed
+    '''
+
+    poll = 0.01
+
+    def __init__(self, client, c, since, tail, timestamps):
+        self.client = client
+        self.c = c
+        self.since = since
+        self.tail = tail
+        self.timestamps = timestamps
+        self.closed = False
+
+    def __iter__(self):
+        sent = None
+        while not self.closed:
+            lines = self.client.due(self.c, self.since)
+            if sent is None:
+                # tail only applies to the lines there already are
+                sent = 0 if self.tail == 'all' else max(0, len(lines) - self.tail)
+            for ts, text in lines[sent:]:
+                yield self.client.format(ts, text, self.timestamps)
+            sent = len(lines)
+            if self.c['State'] != 'running':
+                return
+            time.sleep(self.poll)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDockerClient:
+    '''
+    in-memory stand-in for docker.Client, enough for the ngrok manager
+
+    every call sleeps `latency` seconds and is counted per method.
+    containers write `noise_lines` log lines, then one "Tunnel established
+    at" line per tunnel of their config, `establish_delay` seconds later
+    '''
+
+    def __init__(self, latency=0.0, noise_lines=0, domain='tunnel.example.com',
+                 establish_delay=0.0):
+        self.latency = latency
+        self.noise_lines = noise_lines
+        self.domain = domain
+        self.establish_delay = establish_delay
+        self.containers_by_id = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def call(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_calls(self):
+        with self.lock:
+            calls = self.calls
+            self.calls = {}
+        return calls
+
+    def find(self, container):
+        c = self.containers_by_id.get(container)
+        if c is None:
+            raise Exception('404 no such container: {0}'.format(container))
+        return c
+
+    def containers(self, all=False, filters=None):
+        self.call('containers')
+        name = (filters or {}).get('name', '')
+        res = []
+        for c in list(self.containers_by_id.values()):
+            if name not in c['Name']:
+                continue
+            if not all and c['State'] != 'running':
+                continue
+            res.append({
+                'Id': c['Id'],
+                'Names': ['/' + c['Name']],
+                'State': c['State'],
+                'Status': c['Status'],
+                'Labels': c['Labels']
+            })
+        return res
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def create_container(self, name, image, command=None, volumes=None,
+                         labels=None, host_config=None, **kwargs):
+        self.call('create_container')
+        for c in self.containers_by_id.values():
+            if c['Name'] == name:
+                raise Exception('409 conflict: {0}'.format(name))
+        container_id = uuid.uuid4().hex
+        self.containers_by_id[container_id] = {
+            'Id': container_id,
+            'Name': name,
+            'State': 'created',
+            'Status': 'Created',
+            'Labels': labels or {},
+            'Command': command,
+            'Log': []
+        }
+        return {'Id': container_id}
+
+    def inspect_container(self, container):
+        self.call('inspect_container')
+        c = self.find(container)
+        return {'Id': c['Id'], 'Name': '/' + c['Name'], 'Config': {'Labels': c['Labels']}}
+
+    def rename(self, container, name):
+        self.call('rename')
+        self.find(container)['Name'] = name
+
+    def start(self, container, **kwargs):
+        self.call('start')
+        c = self.find(container)
+        c['State'] = 'running'
+        c['Status'] = 'Up 1 second'
+        self.write_log(c)
+
+    def restart(self, container, timeout=10):
+        self.call('restart')
+        c = self.find(container)
+        c['State'] = 'running'
+        c['Status'] = 'Up 1 second'
+        self.write_log(c)
+
+    def stop(self, container, timeout=10):
+        self.call('stop')
+        c = self.find(container)
+        c['State'] = 'exited'
+        c['Status'] = 'Exited (0) 1 second ago'
+
+    def remove_container(self, container, **kwargs):
+        self.call('remove_container')
+        self.find(container)
+        del self.containers_by_id[container]
+
+    def urls(self, c):
+        '''
+        established urls of the tunnels in the config of a container
+        '''
+        matched = re.search(r'-config (\S+)', c['Command'] or '')
+        try:
+            with open(matched.group(1)) as f:
+                tunnels = yaml.safe_load(f)['tunnels']
+        except (AttributeError, OSError, KeyError, TypeError):
+            tunnels = None
+        if not tunnels:
+            name = c['Name'].strip('_').split('_', 1)[-1]
+            return ['http://{0}.{1}'.format(name, self.domain)]
+
+        urls = []
+        for port_map in tunnels.values():
+            proto = list(port_map['proto'])[0]
+            if proto == 'tcp':
+                urls.append('tcp://{0}:{1}'.format(self.domain, port_map.get('remote_port', 0)))
+            else:
+                host = port_map.get('hostname') or '{0}.{1}'.format(
+                    port_map['subdomain'], self.domain)
+                urls.append('{0}://{1}'.format(proto, host))
+        return urls
+
+    def write_log(self, c):
+        now = time.time()
+        lines = []
+        for i in range(self.noise_lines):
+            lines.append((now, '[INFO] [client] Reading configuration file'))
+        for url in self.urls(c):
+            lines.append((now + self.establish_delay,
+                          '[INFO] [client] Tunnel established at {0}'.format(url)))
+        c['Log'].extend(lines)
+
+    def due(self, c, since):
+        now = time.time()
+        return [l for l in c['Log'] if l[0] <= now and (not since or l[0] >= since)]
+
+    @staticmethod
+    def format(ts, text, timestamps):
+        if timestamps:
+            stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ts))
+            text = '{0}.{1:09d}Z {2}'.format(stamp, int(ts % 1 * 10**9), text)
+        return (text + '\n').encode()
+
+    def logs(self, container, stdout=True, stderr=True, stream=False,
+             timestamps=False, tail='all', since=None, follow=None):
+        self.call('logs')
+        c = self.find(container)
+        if stream and follow:
+            return FakeLogStream(self, c, since, tail, timestamps)
+        lines = self.due(c, since)
+        if tail != 'all':
+            lines = lines[-tail:] if tail else []
+        out = [self.format(ts, text, timestamps) for ts, text in lines]
+        if stream:
+            return iter(out)
+        return b''.join(out)
+
+    def events(self, **kwargs):
+        self.call('events')
+        return iter([])
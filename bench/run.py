@@ -0,0 +1,168 @@
+'''
+benchmark NgrokManager hot paths against a fake docker daemon
+
+    python -m bench.run --sizes 10,100,1000 --latency 0.002 --noise 50
+
+prints one json document with latency percentiles, docker calls and
+sqlite queries per request for every operation and tunnel count
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+class QueryCounter:
+
+    def __init__(self, db):
+        self.count = 0
+        execute_sql = db.execute_sql
+
+        def counted(*args, **kwargs):
+            self.count += 1
+            return execute_sql(*args, **kwargs)
+        db.execute_sql = counted
+
+    def reset(self):
+        count = self.count
+        self.count = 0
+        return count
+
+
+def measure(name, func, args_list, docker_cli, queries, setup=None):
+    '''
+    run func once per args, setup(*args) runs before each call untimed
+    '''
+    # the same percentile as the readiness api
+    from core.ngrokmanager import percentile
+
+    latencies = []
+    docker_calls = 0
+    sqlite_queries = 0
+    docker_cli.reset_calls()
+    queries.reset()
+    for args in args_list:
+        if setup:
+            setup(*args)
+            docker_cli.reset_calls()
+            queries.reset()
+        begin = time.time()
+        func(*args)
+        latencies.append(time.time() - begin)
+        docker_calls += sum(docker_cli.reset_calls().values())
+        sqlite_queries += queries.reset()
+
+    latencies.sort()
+    n = len(args_list)
+    return {
+        'op': name,
+        'requests': n,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None,
+        'docker_calls_per_request': docker_calls / float(n) if n else 0,
+        'sqlite_queries_per_request': sqlite_queries / float(n) if n else 0
+    }
+
+
+def run_size(size, args, workdir):
+    from model import db, database_init, Tunnel
+    from core.ngrokmanager import NgrokManager
+    from bench.fakedocker import FakeDockerClient
+
+    db_path = os.path.join(workdir, 'bench_{0}.db'.format(size))
+    db.init(db_path)
+    database_init()
+    queries = QueryCounter(db)
+
+    docker_cli = FakeDockerClient(latency=args.latency, noise_lines=args.noise,
+                                  establish_delay=args.establish_delay)
+    manager = NgrokManager(None, docker_cli=docker_cli)
+
+    tunnel_dicts = [{
+        'name': 'bench{0}'.format(i),
+        'localaddr': '127.0.0.1:{0}'.format(8000 + i % 1000),
+        'proto': 'http'
+    } for i in range(size)]
+
+    results = []
+    results.append(measure('create', manager.create, [(d,) for d in tunnel_dicts], docker_cli, queries))
+    ids = [t.id for t in Tunnel.select(Tunnel.id)]
+    sample = [(ids[i % len(ids)],) for i in range(args.repeat)]
+
+    results.append(measure('list', manager.list, [()] * args.repeat, docker_cli, queries))
+    results.append(measure('get', manager.get, sample, docker_cli, queries))
+    results.append(measure('status', manager.status, sample, docker_cli, queries))
+    results.append(measure('log', manager.log, sample, docker_cli, queries))
+    # right after a restart, before the established line: the log is
+    # rescanned on every read, and waiting follows it
+    results.append(measure('get_pending', manager.get, sample, docker_cli, queries,
+                           setup=manager.rebuild))
+    timeout = args.establish_delay * 10 + 5
+    results.append(measure('wait', lambda id: manager.wait(id, timeout), sample,
+                           docker_cli, queries, setup=manager.rebuild))
+    results.append(measure('clear', manager.clear, [()], docker_cli, queries))
+
+    for result in results:
+        result['tunnels'] = size
+    db.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every fake docker call takes')
+    parser.add_argument('--noise', type=int, default=20,
+                        help='log lines before "Tunnel established at"')
+    parser.add_argument('--establish-delay', type=float, default=0.2,
+                        help='seconds from start to "Tunnel established at"')
+    parser.add_argument('--per-container', type=int, default=1,
+                        help='tunnels packed into one container')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='requests per read operation')
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='ngrok-bench-')
+    # keep the fake run away from the real runtime dir and daemon
+    os.environ['RUNTIME_DIR'] = workdir
+    os.environ['RUNTIME_DIR_IN_CONTAINER'] = workdir
+    os.environ['DOCKER_EVENTS'] = 'False'
+    os.environ['WARM_POOL_SIZE'] = '0'
+    os.environ['TUNNELS_PER_CONTAINER'] = str(args.per_container)
+    # no background passes polluting the call and query counts
+    os.environ['RECONCILE_INTERVAL'] = '0'
+    os.environ['SUPERVISE_INTERVAL'] = '0'
+    os.environ['TRAFFIC_INTERVAL'] = '0'
+    # measure the reads themselves, not cache hits
+    os.environ['RESULT_CACHE_TTL'] = '0'
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        results.extend(run_size(size, args, workdir))
+
+    report = {
+        'version': 1,
+        'time': int(time.time()),
+        'python': sys.version.split()[0],
+        'latency': args.latency,
+        'noise': args.noise,
+        'establish_delay': args.establish_delay,
+        'per_container': args.per_container,
+        'results': results
+    }
+    out = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(out)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(out)
+
+
+if __name__ == '__main__':
+    main()
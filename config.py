@@ -1,9 +1,100 @@
 import os
+import signal
+import threading
+import time
 import configparser
 
 
-def get_config(section, key):
-    config = configparser.ConfigParser()
-    path = 'app.conf'
-    config.read(path)
-    return os.environ.get(key.upper()) or config.get(section, key)
+UNSET = object()
+
+
+class Config:
+    '''
+    app.conf parsed once, reloaded on SIGHUP or when the file changes
+    '''
+
+    # seconds between two mtime checks
+    check_interval = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.parser = None
+        self.mtime = None
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        parser = configparser.ConfigParser()
+        parser.read(self.path)
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        with self.lock:
+            self.parser = parser
+            self.mtime = mtime
+            self.checked = time.time()
+
+    def check(self):
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self.mtime:
+            self.reload()
+
+    def get(self, section, key, fallback=UNSET):
+        '''
+        fallback is returned when neither the environment nor app.conf
+        has the key, an app.conf older than the key still loads
+        '''
+        self.check()
+        value = os.environ.get(key.upper())
+        if value:
+            return value
+        if fallback is UNSET:
+            return self.parser.get(section, key)
+        return self.parser.get(section, key, fallback=fallback)
+
+    def getboolean(self, section, key, fallback=UNSET):
+        return str(self.get(section, key, fallback)).lower() in ("true", "1")
+
+    def getint(self, section, key, fallback=UNSET):
+        return int(self.get(section, key, fallback))
+
+    def getfloat(self, section, key, fallback=UNSET):
+        return float(self.get(section, key, fallback))
+
+
+config = Config('app.conf')
+
+
+def get_config(section, key, fallback=UNSET):
+    return config.get(section, key, fallback)
+
+
+def get_config_bool(section, key, fallback=UNSET):
+    return config.getboolean(section, key, fallback)
+
+
+def get_config_int(section, key, fallback=UNSET):
+    return config.getint(section, key, fallback)
+
+
+def get_config_float(section, key, fallback=UNSET):
+    return config.getfloat(section, key, fallback)
+
+
+def install_reload_signal():
+    '''
+    reload app.conf on SIGHUP, only possible from the main thread
+    '''
+    try:
+        signal.signal(signal.SIGHUP, lambda signum, frame: config.reload())
+    except (ValueError, AttributeError):
+        pass
@@ -0,0 +1,151 @@
+from urllib.parse import urlencode, urlsplit
+import asyncio
+import json
+import struct
+
+
+class AsyncDockerError(Exception):
+
+    def __init__(self, status, message):
+        super(AsyncDockerError, self).__init__('{0} {1}'.format(status, message))
+        self.status = status
+        self.message = message
+
+
+class AsyncDockerClient:
+    '''
+    the few docker api calls the asgi server needs, over asyncio streams
+    '''
+
+    def __init__(self, base_url, version='1.24', timeout=60):
+        parts = urlsplit(base_url)
+        if parts.scheme in ('unix', 'http+unix'):
+            # unix://var/run/docker.sock means /var/run/docker.sock
+            self.socket_path = '/' + (parts.netloc + parts.path).lstrip('/')
+            self.host = None
+        else:
+            self.socket_path = None
+            self.host = (parts.hostname, parts.port or 2375)
+        self.version = version
+        self.timeout = timeout
+
+    async def open(self):
+        if self.socket_path:
+            return await asyncio.open_unix_connection(self.socket_path)
+        return await asyncio.open_connection(*self.host)
+
+    async def request(self, method, path, params=None):
+        '''
+        send a request, return status, headers and the open reader
+        '''
+        reader, writer = await asyncio.wait_for(self.open(), self.timeout)
+        try:
+            url = '/v{0}{1}'.format(self.version, path)
+            if params:
+                url += '?' + urlencode(params)
+            writer.write('{0} {1} HTTP/1.1\r\nHost: docker\r\nConnection: close\r\n\r\n'.format(
+                method, url).encode())
+            await asyncio.wait_for(writer.drain(), self.timeout)
+
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                k, v = line.decode('latin-1').split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+        except BaseException:
+            # the caller only closes the connection of a returned response
+            writer.close()
+            raise
+        return status, headers, reader, writer
+
+    async def body(self, headers, reader, timeout):
+        '''
+        chunks of the response body, chunked encoding removed
+        '''
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(size_line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    return
+                chunk = await asyncio.wait_for(reader.readexactly(size + 2), timeout)
+                yield chunk[:-2]
+        elif 'content-length' in headers:
+            yield await asyncio.wait_for(
+                reader.readexactly(int(headers['content-length'])), timeout)
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(65536), timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def get_json(self, path, params=None):
+        status, headers, reader, writer = await self.request('GET', path, params)
+        try:
+            data = b''
+            async for chunk in self.body(headers, reader, self.timeout):
+                data += chunk
+        finally:
+            writer.close()
+        if status >= 400:
+            raise AsyncDockerError(status, data.decode(errors='replace'))
+        return json.loads(data.decode())
+
+    async def containers(self, all=False, filters=None):
+        params = {'all': 1 if all else 0}
+        if filters:
+            params['filters'] = json.dumps(dict(
+                (k, v if isinstance(v, list) else [v]) for k, v in filters.items()))
+        return await self.get_json('/containers/json', params)
+
+    async def logs(self, container, since=0, tail='all', follow=False,
+                   timestamps=True, timeout=None):
+        '''
+        stdout lines of a container, timeout applies to every read
+        '''
+        params = {
+            'stdout': 1,
+            'stderr': 0,
+            'timestamps': 1 if timestamps else 0,
+            'follow': 1 if follow else 0,
+            'tail': tail
+        }
+        if since:
+            params['since'] = int(since)
+        status, headers, reader, writer = await self.request(
+            'GET', '/containers/{0}/logs'.format(container), params)
+        if timeout is None and not follow:
+            timeout = self.timeout
+        try:
+            if status >= 400:
+                raise AsyncDockerError(status, 'logs of {0}'.format(container))
+            buf = b''
+            async for payload in self.demux(self.body(headers, reader, timeout)):
+                buf += payload
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    yield line.decode(errors='replace').rstrip('\r')
+            if buf:
+                yield buf.decode(errors='replace').rstrip('\r')
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def demux(chunks):
+        '''
+        strip the 8 byte frame headers of a non-tty log stream
+        '''
+        buf = b''
+        async for chunk in chunks:
+            buf += chunk
+            while len(buf) >= 8:
+                size = struct.unpack('>I', buf[4:8])[0]
+                if len(buf) < 8 + size:
+                    break
+                yield buf[8:8 + size]
+                buf = buf[8 + size:]
@@ -0,0 +1,260 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import time
+
+from model import Tunnel
+from core.asyncdocker import AsyncDockerClient
+from core.error import TunnelManagerError
+from core.logbroker import TaggedQueue
+from core.ngrokwrapper import LogPage, StatusScan
+
+
+class AsyncLogChannel:
+    '''
+    one followed log stream of a container, fanned out to asyncio queues
+    '''
+
+    def __init__(self, broker, name, container_id):
+        self.broker = broker
+        self.name = name
+        self.container_id = container_id
+        self.subscribers = set()
+        self.task = asyncio.ensure_future(self.run())
+
+    def publish(self, event, data):
+        for q in list(self.subscribers):
+            q.put_nowait((event, data))
+
+    async def run(self):
+        # every established line, subscribers of a shared container
+        # keep the ones of their own tunnel
+        scan = StatusScan()
+        try:
+            async for line in self.broker.docker.logs(
+                    self.container_id, since=int(time.time()), tail=0, follow=True):
+                self.publish('log', line)
+                if scan.feed(line):
+                    self.publish('status', scan.result()[0])
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            self.publish('error', str(e))
+        self.broker.close(self)
+        self.publish('status', None)
+        self.publish('end', None)
+
+
+class AsyncLogBroker:
+
+    def __init__(self, docker):
+        self.docker = docker
+        self.channels = {}
+
+    def subscribe(self, name, container_id, q=None):
+        channel = self.channels.get(name)
+        if channel is None or channel.container_id != container_id:
+            channel = AsyncLogChannel(self, name, container_id)
+            self.channels[name] = channel
+        if q is None:
+            q = asyncio.Queue()
+        channel.subscribers.add(q)
+        return channel, q
+
+    def unsubscribe(self, channel, q):
+        channel.subscribers.discard(q)
+        if not channel.subscribers:
+            channel.task.cancel()
+            self.close(channel)
+
+    def close(self, channel):
+        if self.channels.get(channel.name) is channel:
+            del self.channels[channel.name]
+
+
+class AsyncNgrokManager:
+    '''
+    NgrokManager operations as coroutines
+
+    docker reads (container snapshots, logs, streams) go through the async
+    client, database work runs on a thread pool
+    '''
+
+    # log scans running at once
+    max_scans = 16
+
+    def __init__(self, manager, docker_url, max_workers=16):
+        self.manager = manager
+        self.docker = AsyncDockerClient(docker_url)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.log_broker = AsyncLogBroker(self.docker)
+
+    async def call(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def snapshot(self):
+        if self.manager.watcher:
+            containers = self.manager.watcher.snapshot()
+            if containers is not None:
+                return containers
+
+        containers = {}
+        for container in await self.docker.containers(all=True, filters={'name': 'ngrok_'}):
+            for name in container.get('Names') or []:
+                containers[name.lstrip('/')] = container
+        return containers
+
+    async def instance(self, id):
+        try:
+            return await self.call(self.manager.get_tunnel_instance_by_id, id)
+        except Tunnel.DoesNotExist as e:
+            raise TunnelManagerError(e, 'id does not exist in db')
+
+    async def cached(self, key):
+        '''
+        a fresh cached result, saves scanning logs for nothing
+        '''
+        cache = self.manager.cache
+        if cache.ttl <= 0:
+            return None
+        return await self.call(lambda: cache.read(key, cache.generation()))
+
+    async def scan(self, snapshot, ids=None):
+        '''
+        status of the running tunnels without stored mapping, read from
+        their logs with the async client
+        '''
+        pending = await self.call(self.manager.unmapped, snapshot, ids)
+        semaphore = asyncio.Semaphore(self.max_scans)
+
+        async def scan_one(container_id, start_time, member):
+            async with semaphore:
+                scan = StatusScan(member)
+                lines = self.docker.logs(container_id, since=start_time)
+                try:
+                    async for line in lines:
+                        if scan.feed(line):
+                            break
+                finally:
+                    await lines.aclose()
+                return scan.result()
+
+        results = await asyncio.gather(*[
+            scan_one(container_id, start_time, member)
+            for _, container_id, start_time, member in pending])
+        return dict((p[0], result) for p, result in zip(pending, results))
+
+    async def list(self):
+        entry = await self.cached('list')
+        if entry:
+            return entry['value']
+        snapshot = await self.snapshot()
+        scanned = await self.scan(snapshot)
+        return await self.call(
+            self.manager.cache.get, 'list',
+            lambda: self.manager.list_uncached(snapshot, scanned))
+
+    async def get(self, id):
+        key = 'tunnel-{0}'.format(id)
+        entry = await self.cached(key)
+        if entry:
+            return entry['value']
+        snapshot = await self.snapshot()
+        scanned = await self.scan(snapshot, [id])
+        return await self.call(
+            self.manager.cache.get, key,
+            lambda: self.manager.get_uncached(id, snapshot, scanned))
+
+    async def status(self, id):
+        snapshot = await self.snapshot()
+        scanned = await self.scan(snapshot, [id])
+        return await self.call(self.manager.status, id, snapshot, scanned)
+
+    async def log(self, id, cursor=None, offset=0, limit=10, tail=None):
+        '''
+        same as Ngrok.log(), reading the log without a thread
+        '''
+        tunnel_instance = await self.instance(id)
+        container = (await self.snapshot()).get(tunnel_instance.name)
+        if not container:
+            raise TunnelManagerError(None, 'container no exists')
+
+        page = LogPage(cursor, offset, limit)
+        since, tail = page.since(tunnel_instance.start_time, tail)
+        lines = self.docker.logs(container.get('Id'), since=since, tail=tail)
+        try:
+            async for line in lines:
+                if page.feed(line):
+                    break
+        finally:
+            await lines.aclose()
+        return page.result()
+
+    async def stream(self, id, heartbeat=15):
+        '''
+        current status, then new log lines and status changes
+        '''
+        tunnel_instance = await self.instance(id)
+        yield 'status', await self.status(id)
+
+        container = (await self.snapshot()).get(tunnel_instance.name)
+        if not container or container.get('State') != 'running':
+            return
+
+        channel, q = self.log_broker.subscribe(tunnel_instance.name, container.get('Id'))
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(q.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield 'heartbeat', None
+                    continue
+                if event == 'end':
+                    return
+                if (event == 'status' and data and tunnel_instance.member and
+                        not tunnel_instance.member.matches(data['url'])):
+                    continue
+                yield event, data
+        finally:
+            self.log_broker.unsubscribe(channel, q)
+
+    async def stream_many(self, ids, heartbeat=15):
+        '''
+        same as NgrokManager.stream_many()
+        '''
+        instances = [(id, await self.instance(id)) for id in ids]
+        snapshot = await self.snapshot()
+
+        q = asyncio.Queue()
+        subscribed = {}
+        try:
+            for id, tunnel_instance in instances:
+                yield 'status', {'id': id, 'data': await self.status(id)}
+                container = snapshot.get(tunnel_instance.name)
+                if container and container.get('State') == 'running':
+                    tagged = TaggedQueue(q, id)
+                    channel, _ = self.log_broker.subscribe(
+                        tunnel_instance.name, container.get('Id'), tagged)
+                    subscribed[id] = (tunnel_instance, channel, tagged)
+
+            while subscribed:
+                try:
+                    id, event, data = await asyncio.wait_for(q.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield 'heartbeat', None
+                    continue
+                if id not in subscribed:
+                    continue
+                tunnel_instance = subscribed[id][0]
+                if event == 'end':
+                    self.log_broker.unsubscribe(*subscribed.pop(id)[1:])
+                    yield 'end', {'id': id, 'data': None}
+                    continue
+                if (event == 'status' and data and tunnel_instance.member and
+                        not tunnel_instance.member.matches(data['url'])):
+                    continue
+                yield event, {'id': id, 'data': data}
+        finally:
+            for _, channel, tagged in subscribed.values():
+                self.log_broker.unsubscribe(channel, tagged)
@@ -0,0 +1,23 @@
+import os
+import threading
+
+
+def write_atomic(path, data, sync=False):
+    '''
+    write data (bytes or str) to a temp file and rename it over path,
+    readers see the old or the new content, never a partial one
+
+    the temp file is unique per process and thread, sync also flushes it
+    to disk before the rename
+    '''
+    tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
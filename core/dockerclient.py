@@ -0,0 +1,176 @@
+from contextlib import contextmanager
+from docker import Client
+import json
+import socket
+import threading
+import time
+
+
+UNSET = object()
+
+
+class Flight:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LogStream:
+    '''
+    a streamed log response another thread can close
+
+    docker-py disables the socket timeout of log streams, shutting the
+    socket down is the only way to wake a reader blocked on it
+    '''
+
+    def __init__(self, cli, response, chunks):
+        self.cli = cli
+        self.response = response
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        try:
+            sock = self.cli._get_raw_response_socket(self.response)
+            sock = getattr(sock, '_sock', sock)
+            sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        self.response.close()
+
+
+def close_stream(stream):
+    '''
+    close a log stream from any thread, plain generators can only be
+    closed when nobody is reading them
+    '''
+    try:
+        stream.close()
+    except (AttributeError, ValueError):
+        pass
+
+
+class DockerClient(Client):
+    '''
+    docker client shared by all threads of a worker
+
+    - pooled connections to the daemon socket
+    - separate timeouts for list, log and stop calls
+    - identical concurrent containers() queries share one request
+    - call durations reported to the observers
+    '''
+
+    def __init__(self, base_url, timeout=60, num_pools=32,
+                 list_timeout=5, log_timeout=30, stop_timeout=5):
+        super(DockerClient, self).__init__(
+            base_url=base_url, timeout=timeout, num_pools=num_pools)
+        self.list_timeout = list_timeout
+        self.log_timeout = log_timeout
+        # on top of the stop grace period
+        self.stop_timeout = stop_timeout
+
+        self.local = threading.local()
+        self.flights = {}
+        self.flights_lock = threading.Lock()
+        self.observers = []
+
+    def _set_request_timeout(self, kwargs):
+        timeout = getattr(self.local, 'timeout', UNSET)
+        if timeout is not UNSET:
+            kwargs.setdefault('timeout', timeout)
+        return super(DockerClient, self)._set_request_timeout(kwargs)
+
+    @contextmanager
+    def call_timeout(self, seconds):
+        '''
+        request timeout for the calls made in this block, this thread only
+        '''
+        old = getattr(self.local, 'timeout', UNSET)
+        self.local.timeout = seconds
+        try:
+            yield
+        finally:
+            self.local.timeout = old
+
+    @contextmanager
+    def observe(self, method):
+        begin = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - begin
+            for observer in self.observers:
+                observer(method, seconds)
+
+    def containers(self, **kwargs):
+        key = json.dumps(kwargs, sort_keys=True)
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+
+        if not leader:
+            # the same query is already running, wait for its answer
+            flight.event.wait()
+            if flight.error:
+                raise flight.error
+            return [dict(c) for c in flight.result]
+
+        try:
+            with self.observe('containers'), self.call_timeout(self.list_timeout):
+                flight.result = super(DockerClient, self).containers(**kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight.event.set()
+
+    def logs(self, container, **kwargs):
+        # a followed stream waits for new lines, never time it out,
+        # close_stream() ends it
+        timeout = None if kwargs.get('follow') else self.log_timeout
+        with self.observe('logs'), self.call_timeout(timeout):
+            return super(DockerClient, self).logs(container, **kwargs)
+
+    def _get_result_tty(self, stream, res, is_tty):
+        result = super(DockerClient, self)._get_result_tty(stream, res, is_tty)
+        if stream:
+            return LogStream(self, res, result)
+        return result
+
+    def stop(self, container, timeout=10):
+        with self.observe('stop'):
+            params = {'t': timeout}
+            url = self._url("/containers/{0}/stop", container)
+            res = self._post(url, params=params, timeout=(timeout + self.stop_timeout))
+            self._raise_for_status(res)
+
+    def start(self, container, **kwargs):
+        with self.observe('start'):
+            return super(DockerClient, self).start(container, **kwargs)
+
+    def restart(self, container, **kwargs):
+        with self.observe('restart'):
+            return super(DockerClient, self).restart(container, **kwargs)
+
+    def create_container(self, *args, **kwargs):
+        with self.observe('create_container'):
+            return super(DockerClient, self).create_container(*args, **kwargs)
+
+    def remove_container(self, container, **kwargs):
+        with self.observe('remove_container'):
+            return super(DockerClient, self).remove_container(container, **kwargs)
+
+    def events(self, **kwargs):
+        # a long lived stream as well
+        with self.observe('events'), self.call_timeout(None):
+            return super(DockerClient, self).events(**kwargs)
@@ -0,0 +1,122 @@
+import re
+import threading
+import time
+
+
+class ContainerWatcher:
+    '''
+    keep the state of ngrok containers in memory, fed by docker events
+    '''
+
+    prefix = 'ngrok_'
+
+    def __init__(self, docker_cli, retry_interval=1):
+        self.cli = docker_cli
+        self.retry_interval = retry_interval
+        self.containers = {}
+        self.synced = False
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name='ngrok-docker-events')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                # events since the resync are replayed, so nothing is missed
+                since = int(time.time())
+                self.resync()
+                events = self.cli.events(
+                    since=since, filters={'type': 'container'}, decode=True)
+                for event in events:
+                    self.handle(event)
+            except Exception as e:
+                print('docker events stream lost: {0}'.format(e))
+            # stream ended or broke, fall back to direct queries until resynced
+            self.synced = False
+            time.sleep(self.retry_interval)
+
+    def snapshot(self):
+        '''
+        containers indexed by name, None when the cache is not usable
+        '''
+        if not self.synced:
+            return None
+        with self.lock:
+            return dict(self.containers)
+
+    def resync(self):
+        containers = {}
+        for container in self.cli.containers(all=True, filters={'name': self.prefix}):
+            for name in container.get('Names') or []:
+                containers[name.lstrip('/')] = self.from_container(container)
+        with self.lock:
+            self.containers = containers
+        self.synced = True
+
+    def refresh(self, name):
+        '''
+        reload one container right after we changed it ourselves
+        '''
+        res = self.cli.containers(all=True, filters={'name': name})
+        with self.lock:
+            self.containers.pop(name, None)
+            for container in res:
+                for n in container.get('Names') or []:
+                    n = n.lstrip('/')
+                    if n.startswith(self.prefix):
+                        self.containers[n] = self.from_container(container)
+
+    def handle(self, event):
+        actor = event.get('Actor') or {}
+        attributes = actor.get('Attributes') or {}
+        name = attributes.get('name', '')
+        action = event.get('Action') or event.get('status') or ''
+        container_id = actor.get('ID') or event.get('id')
+
+        if action == 'rename':
+            old_name = attributes.get('oldName', '').lstrip('/')
+            with self.lock:
+                self.containers.pop(old_name, None)
+        if not name.startswith(self.prefix):
+            return
+
+        with self.lock:
+            container = self.containers.get(name)
+            if action == 'destroy':
+                self.containers.pop(name, None)
+                return
+            if container is None or container.get('Id') != container_id:
+                container = {'Id': container_id, 'Names': ['/' + name], 'State': None, 'ExitCode': None}
+                self.containers[name] = container
+
+            if action == 'create':
+                container['State'] = 'created'
+            elif action in ('start', 'restart', 'unpause'):
+                container['State'] = 'running'
+                container['ExitCode'] = None
+            elif action == 'die':
+                container['State'] = 'exited'
+                exit_code = attributes.get('exitCode')
+                container['ExitCode'] = int(exit_code) if exit_code is not None else None
+            elif action == 'pause':
+                container['State'] = 'paused'
+
+    @staticmethod
+    def from_container(container):
+        # the list api only reports the exit code in the status text
+        exit_code = None
+        matched = re.search(r'Exited \((-?\d+)\)', container.get('Status') or '')
+        if matched:
+            exit_code = int(matched.group(1))
+        return {
+            'Id': container.get('Id'),
+            'Names': container.get('Names'),
+            'State': container.get('State'),
+            'ExitCode': exit_code
+        }
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+import uuid
+
+from model import Job
+
+
+class JobRunner:
+    '''
+    run tunnel work in the background, progress is kept in the job table
+    so every worker can report it
+    '''
+
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, tunnel_id, func):
+        '''
+        func is called with a progress(state, url='', msg='') callback
+        '''
+        now = int(time.time())
+        job = Job.create(
+            uuid=uuid.uuid4().hex,
+            tunnel_id=tunnel_id,
+            state='pending',
+            created=now,
+            updated=now
+        )
+        self.executor.submit(self.run, job.uuid, func)
+        return job
+
+    def run(self, job_uuid, func):
+        def progress(state, url='', msg='', done=False):
+            Job.update(
+                state=state,
+                url=url,
+                msg=msg,
+                done=done,
+                updated=int(time.time())
+            ).where(Job.uuid == job_uuid).execute()
+
+        try:
+            func(progress)
+        except Exception as e:
+            msg = getattr(e, 'message', '') or str(e)
+            progress('failed', msg=msg, done=True)
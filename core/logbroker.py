@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+
+from core.dockerclient import close_stream
+from core.ngrokwrapper import StatusScan, split_lines
+
+
+class LogChannel:
+    '''
+    one followed docker log stream, fanned out to every subscriber
+    '''
+
+    def __init__(self, broker, tunnel_instance):
+        self.broker = broker
+        self.tunnel_instance = tunnel_instance
+        self.subscribers = []
+        self.stream = None
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self.run, name='ngrok-log-' + tunnel_instance.name)
+        self.thread.daemon = True
+
+    def publish(self, event, data):
+        with self.broker.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            q.put((event, data))
+
+    def run(self):
+        # every established line, subscribers of a shared container
+        # keep the ones of their own tunnel
+        scan = StatusScan()
+        try:
+            # only new lines, history is served by the log api
+            stream = self.tunnel_instance.log_stream(since=int(time.time()), tail=0, follow=True)
+            with self.broker.lock:
+                self.stream = stream
+                closed = self.closed
+            if closed:
+                # everybody left while the stream was opening
+                close_stream(stream)
+                return
+            for line in split_lines(stream):
+                self.publish('log', line)
+                if scan.feed(line):
+                    self.publish('status', scan.result()[0])
+        except Exception as e:
+            if self.closed:
+                return
+            self.publish('error', str(e))
+        if self.closed:
+            return
+        # the container stopped or went away
+        self.broker.close(self)
+        self.publish('status', None)
+        self.publish('end', None)
+
+
+class TaggedQueue:
+    '''
+    puts (tag, event, data) into a queue several channels share, a stream
+    of many tunnels tells their events apart by the tag
+    '''
+
+    def __init__(self, q, tag):
+        self.q = q
+        self.tag = tag
+
+    def put(self, item):
+        self.q.put((self.tag,) + item)
+
+    def put_nowait(self, item):
+        self.q.put_nowait((self.tag,) + item)
+
+
+class LogBroker:
+
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, tunnel_instance, q=None):
+        if q is None:
+            q = queue.Queue()
+        with self.lock:
+            channel = self.channels.get(tunnel_instance.name)
+            if channel is None:
+                channel = LogChannel(self, tunnel_instance)
+                self.channels[tunnel_instance.name] = channel
+                channel.thread.start()
+            channel.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, tunnel_instance, q):
+        '''
+        the last subscriber to leave closes the followed stream
+        '''
+        with self.lock:
+            channel = self.channels.get(tunnel_instance.name)
+            if not channel or q not in channel.subscribers:
+                return
+            channel.subscribers.remove(q)
+            if channel.subscribers:
+                return
+            del self.channels[tunnel_instance.name]
+            channel.closed = True
+            stream = channel.stream
+        if stream is not None:
+            close_stream(stream)
+
+    def close(self, channel):
+        with self.lock:
+            if self.channels.get(channel.tunnel_instance.name) is channel:
+                del self.channels[channel.tunnel_instance.name]
@@ -0,0 +1,188 @@
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+from core.atomicfile import write_atomic
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    '''
+    counters and histograms kept in memory, flushed once a second to one
+    file per process so every gunicorn worker can serve the sum
+
+    a process holds a lock on <ident>.lock next to its <ident>.json while
+    it lives, the files of a process gone without removing them are
+    dropped by the next collect()
+    '''
+
+    flush_interval = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flushed = 0
+        # pid and a random part, a reused pid does not take over old files
+        self.ident = None
+        self.owner = None
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                # one count per bucket, then sum and count
+                h = [0] * len(BUCKETS) + [0.0, 0]
+                self.histograms[key] = h
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if time.time() - self.flushed < self.flush_interval:
+            return
+        # called from the docker and sqlite observers, never fail their call
+        # and let one thread flush while the others go on
+        if not self.flush_lock.acquire(False):
+            return
+        try:
+            self.flush()
+        except OSError as e:
+            print('metrics flush failed: {0}'.format(e))
+        finally:
+            self.flush_lock.release()
+
+    def flush(self):
+        self.flushed = time.time()
+        with self.lock:
+            data = {
+                'counters': [[k[0], k[1], v] for k, v in self.counters.items()],
+                'histograms': [[k[0], k[1], v] for k, v in self.histograms.items()]
+            }
+        file_path = os.path.join(self.path, self.own() + '.json')
+        write_atomic(file_path, json.dumps(data))
+
+    def own(self):
+        '''
+        ident of the files of this process, locked on first use
+        '''
+        if self.owner is None:
+            os.makedirs(self.path, exist_ok=True)
+            ident = '{0}-{1}'.format(os.getpid(), uuid.uuid4().hex[:8])
+            lock_path = os.path.join(self.path, ident + '.lock')
+            # locked before it gets its name, prune() never sees it free
+            owner = open(lock_path + '.tmp', 'w')
+            fcntl.flock(owner, fcntl.LOCK_EX)
+            os.rename(lock_path + '.tmp', lock_path)
+            self.ident, self.owner = ident, owner
+            atexit.register(self.remove, ident)
+        return self.ident
+
+    def remove(self, ident):
+        for ext in ('.json', '.lock'):
+            try:
+                os.remove(os.path.join(self.path, ident + ext))
+            except OSError:
+                pass
+
+    def prune(self):
+        '''
+        drop the files of processes that are gone
+        '''
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith('.json') or file_name == self.ident + '.json':
+                continue
+            ident = file_name[:-len('.json')]
+            try:
+                with open(os.path.join(self.path, ident + '.lock')) as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except FileNotFoundError:
+                # never had a lock, written before files were owned
+                pass
+            except OSError:
+                # locked, its process is alive
+                continue
+            self.remove(ident)
+
+    def collect(self):
+        '''
+        sum of the metrics of every worker
+        '''
+        with self.flush_lock:
+            self.flush()
+            self.prune()
+        counters = {}
+        histograms = {}
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, file_name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in data['counters']:
+                key = (name, tuple(tuple(l) for l in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in data['histograms']:
+                key = (name, tuple(tuple(l) for l in labels))
+                h = histograms.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    h[i] += v
+        return counters, histograms
+
+    def render(self, gauges=None):
+        '''
+        prometheus text format, gauges are computed by the caller
+        '''
+        counters, histograms = self.collect()
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, 'counter')
+            lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+        for (name, labels), h in sorted(histograms.items()):
+            declare(name, 'histogram')
+            for i, bound in enumerate(BUCKETS):
+                le = labels + (('le', str(bound)),)
+                lines.append('{0}_bucket{1} {2}'.format(name, format_labels(le), h[i]))
+            le = labels + (('le', '+Inf'),)
+            lines.append('{0}_bucket{1} {2}'.format(name, format_labels(le), h[-1]))
+            lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), h[-2]))
+            lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), h[-1]))
+        for name, labels, value in gauges or []:
+            declare(name, 'gauge')
+            lines.append('{0}{1} {2}'.format(
+                name, format_labels(tuple(sorted(labels.items()))), value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
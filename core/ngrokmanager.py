@@ -1,20 +1,101 @@
-from docker import Client
+from concurrent.futures import ThreadPoolExecutor
 import json
+import math
 import peewee
+import queue
+import random
 import time
 
-from model import Tunnel, tunnel_to_dict
-from config import get_config
+from model import db, Tunnel, TunnelMapping, TunnelState, TunnelAttempt, Job
+from model import tunnel_to_dict, mapping_to_dict, job_to_dict, state_to_dict, attempt_to_dict
+from config import get_config, get_config_bool, get_config_float, get_config_int
 from core.error import TunnelManagerError
-from core.ngrokwrapper import Ngrok, NgrokConfig
+from core.dockerclient import DockerClient
+from core.dockerwatcher import ContainerWatcher
+from core.supervisor import Supervisor
+from core.traffic import TrafficIngester, BUCKETS
+from core.jobs import JobRunner
+from core.logbroker import LogBroker, TaggedQueue
+from core.reconciler import Reconciler
+from core.resultcache import ResultCache, invalidates
+from core.warmpool import WarmPool
+from core.ngrokwrapper import Ngrok, NgrokConfig, NgrokShardConfig
 
 
 class NgrokManager:
 
-    def __init__(self, docker_url):
-        self.docker_cli = Client(base_url=docker_url)
+    def __init__(self, docker_url, docker_cli=None):
+        if docker_cli is None:
+            docker_cli = DockerClient(
+                docker_url,
+                timeout=get_config_int('basic', 'docker_timeout', 60),
+                num_pools=get_config_int('basic', 'docker_num_pools', 32),
+                list_timeout=get_config_int('basic', 'docker_list_timeout', 5),
+                log_timeout=get_config_int('basic', 'docker_log_timeout', 30),
+                stop_timeout=get_config_int('basic', 'docker_stop_timeout', 5)
+            )
+        self.docker_cli = docker_cli
+        self.bulk_workers = get_config_int('basic', 'bulk_workers', 8)
+        self.jobs = JobRunner(get_config_int('basic', 'job_workers', 4))
+        self.job_timeout = get_config_int('basic', 'job_timeout', 30)
+        self.log_broker = LogBroker()
+        self.cache = ResultCache(
+            get_config('basic', 'result_cache_dir', 'data/cache'),
+            get_config_float('basic', 'result_cache_ttl', 0.5))
+        # more than one packs tunnels into shared containers
+        self.shard_size = get_config_int('ngrok', 'tunnels_per_container', 1)
+
+        self.pool = None
+        pool_size = get_config_int('ngrok', 'warm_pool_size', 0)
+        if pool_size > 0:
+            self.pool = WarmPool(self.docker_cli, pool_size)
+            self.pool.start()
+
+        self.restart_backoff = get_config_float('basic', 'reconcile_backoff', 5)
+        self.restart_max_backoff = get_config_float('basic', 'reconcile_max_backoff', 300)
+        self.attempt_history = get_config_int('basic', 'attempt_history', 100)
+        self.restart_budget = get_config_int('basic', 'restart_budget', 10)
+        self.establish_deadline = get_config_int('basic', 'establish_deadline', 30)
+        self.reconciler = Reconciler(self, get_config_int('basic', 'reconcile_interval', 30))
+        if self.reconciler.interval > 0:
+            self.reconciler.start()
+        self.supervisor = Supervisor(self, get_config_float('basic', 'supervise_interval', 2))
+        if self.supervisor.interval > 0:
+            self.supervisor.start()
+        self.traffic = TrafficIngester(
+            self, get_config_float('basic', 'traffic_interval', 10),
+            get_config_int('basic', 'traffic_batch', 5000))
+        if self.traffic.interval > 0:
+            self.traffic.start()
+
+        self.watcher = None
+        if get_config_bool('basic', 'docker_events', True):
+            self.watcher = ContainerWatcher(self.docker_cli)
+            self.watcher.start()
+
+    def snapshot(self, name='ngrok_'):
+        '''
+        fetch ngrok containers at once, indexed by container name
+        '''
+        if self.watcher:
+            containers = self.watcher.snapshot()
+            if containers is not None:
+                return containers
+
+        containers = {}
+        for container in self.docker_cli.containers(all=True, filters={'name': name}):
+            for n in container.get('Names') or []:
+                containers[n.lstrip('/')] = container
+        return containers
 
-    def get_tunnel_instance(self, tunnel):
+    def refresh(self, tunnel_instance):
+        '''
+        update the cached state after changing a container
+        '''
+        if self.watcher:
+            self.watcher.refresh(tunnel_instance.name)
+
+    def get_ngrok_config(self, tunnel):
         ngrok_config = NgrokConfig(
             name=tunnel.name,
             hostname=tunnel.hostname,
@@ -23,148 +104,965 @@ class NgrokManager:
             proto=tunnel.proto,
             auth=tunnel.auth
         )
+        return ngrok_config
+
+    def get_tunnel_instance(self, tunnel, snapshot=None, shards=None):
+        ngrok_config = self.get_ngrok_config(tunnel)
+        if not self.packed(ngrok_config):
+            tunnel_instance = Ngrok(
+                self.docker_cli, ngrok_config, start_time=tunnel.starttime,
+                snapshot=snapshot, pool=self.pool)
+            return tunnel_instance
+
+        # the container of the shard, reading our own tunnel from its log
+        shard = self.shard_of(tunnel.id)
+        if shards is not None:
+            rows = shards.get(shard, [])
+        else:
+            rows = self.shard_rows(shard)
+        if tunnel.id not in [row.id for row in rows]:
+            # stopped, the shared container does not serve it
+            snapshot = {}
         tunnel_instance = Ngrok(
-            self.docker_cli, ngrok_config, start_time=tunnel.starttime)
+            self.docker_cli, self.get_shard_config(shard, rows),
+            start_time=tunnel.starttime, snapshot=snapshot, member=ngrok_config,
+            pool=self.pool)
         return tunnel_instance
 
+    def packed(self, ngrok_config):
+        return self.shard_size > 1 and ngrok_config.packable()
+
+    def shard_of(self, id):
+        return (int(id) - 1) // self.shard_size
+
+    def shard_rows(self, shard):
+        '''
+        tunnels sharing the container of a shard, stopped ones are left out
+        '''
+        stopped = TunnelState.select(TunnelState.tunnel_id).where(
+            TunnelState.desired == 'stopped')
+        rows = Tunnel.select().where(
+            (Tunnel.id > shard * self.shard_size) &
+            (Tunnel.id <= (shard + 1) * self.shard_size) &
+            (Tunnel.id.not_in(stopped))
+        ).order_by(Tunnel.id)
+        return [row for row in rows if self.get_ngrok_config(row).packable()]
+
+    def group_shards(self, tunnels):
+        '''
+        shard_rows() of every shard of the tunnels, in one query
+        '''
+        shards = {}
+        if self.shard_size <= 1:
+            return shards
+        stopped = set(state.tunnel_id for state in TunnelState.select(
+            TunnelState.tunnel_id).where(TunnelState.desired == 'stopped'))
+        for tunnel in tunnels:
+            if tunnel.id not in stopped and self.get_ngrok_config(tunnel).packable():
+                shards.setdefault(self.shard_of(tunnel.id), []).append(tunnel)
+        return shards
+
+    def get_shard_config(self, shard, rows):
+        members = [self.get_ngrok_config(row) for row in rows]
+        return NgrokShardConfig('_shard{0}'.format(shard), members)
+
+    def container_name(self, tunnel):
+        if self.packed(self.get_ngrok_config(tunnel)):
+            return 'ngrok__shard{0}_'.format(self.shard_of(tunnel.id))
+        return 'ngrok_' + tunnel.name + '_'
+
+    def container_rows(self, tunnel):
+        '''
+        tunnels served by the same container as this one
+        '''
+        if self.packed(self.get_ngrok_config(tunnel)):
+            return self.shard_rows(self.shard_of(tunnel.id))
+        return [tunnel]
+
     def get_tunnel_instance_by_id(self, id):
         tunnel = Tunnel.get(Tunnel.id == id)
         return self.get_tunnel_instance(tunnel)
 
     def update_tunnel_start_time(self, id):
         tunnel = Tunnel.get(Tunnel.id == id)
-        tunnel.starttime = int(time.time())
-        tunnel.save()
+        # a restart of a shared container restarts all its tunnels
+        ids = [row.id for row in self.container_rows(tunnel)]
+        started_at = time.time()
+        tunnel.starttime = int(started_at)
+        Tunnel.update(starttime=tunnel.starttime).where(Tunnel.id << ids).execute()
+        self.clear_tunnel_mapping(*ids)
+        for id in ids:
+            self.add_attempt(id, tunnel.starttime, started_at)
         return tunnel
 
+    def add_attempt(self, id, starttime, started_at):
+        TunnelAttempt.create(tunnel_id=id, starttime=starttime, started_at=started_at)
+        # only keep the recent history
+        old = TunnelAttempt.select(TunnelAttempt.id).where(
+            TunnelAttempt.tunnel_id == id
+        ).order_by(TunnelAttempt.id.desc()).offset(self.attempt_history)
+        old_ids = [row.id for row in old]
+        if old_ids:
+            TunnelAttempt.delete().where(TunnelAttempt.id << old_ids).execute()
+
+    def record_established(self, tunnel, established_at):
+        attempt = TunnelAttempt.select().where(
+            (TunnelAttempt.tunnel_id == tunnel.id) &
+            (TunnelAttempt.starttime == tunnel.starttime) &
+            (TunnelAttempt.established_at >> None)
+        ).order_by(TunnelAttempt.id.desc()).first()
+        if attempt:
+            attempt.established_at = established_at
+            attempt.latency = max(0.0, established_at - attempt.started_at)
+            attempt.save()
+
+    def readiness(self, id=None):
+        '''
+        start to established latency, of one tunnel or of all tunnels
+        '''
+        query = TunnelAttempt.select().order_by(TunnelAttempt.id.desc())
+        if id is not None:
+            query = query.where(TunnelAttempt.tunnel_id == id)
+        attempts = list(query.limit(self.attempt_history if id is not None else 1000))
+
+        latencies = sorted(a.latency for a in attempts if a.latency is not None)
+        result = {
+            'count': len(latencies),
+            'pending': len([a for a in attempts if a.established_at is None]),
+            'percentiles': dict(
+                ('p{0}'.format(p), percentile(latencies, p)) for p in (50, 90, 99))
+        }
+        if id is not None:
+            result['history'] = [attempt_to_dict(a) for a in attempts]
+        else:
+            # slowest tunnels first, to spot slow servers
+            per_tunnel = {}
+            for a in attempts:
+                if a.latency is not None:
+                    per_tunnel.setdefault(a.tunnel_id, []).append(a.latency)
+            result['tunnels'] = sorted([
+                {'tunnel_id': k, 'count': len(v), 'p50': percentile(sorted(v), 50)}
+                for k, v in per_tunnel.items()
+            ], key=lambda t: t['p50'], reverse=True)
+        return result
+
+    def tunnel_states(self, ids):
+        '''
+        state rows of the tunnels, created when missing
+        '''
+        states = dict((state.tunnel_id, state) for state in
+                      TunnelState.select().where(TunnelState.tunnel_id << list(ids)))
+        for id in ids:
+            if id not in states:
+                try:
+                    states[id] = TunnelState.create(tunnel_id=id)
+                except peewee.IntegrityError:
+                    states[id] = TunnelState.get(TunnelState.tunnel_id == id)
+        return states
+
+    def set_desired(self, ids, desired):
+        self.tunnel_states(ids)
+        TunnelState.update(desired=desired).where(TunnelState.tunnel_id << list(ids)).execute()
+
+    def reset_failures(self, ids):
+        TunnelState.update(failures=0, next_attempt=0).where(
+            TunnelState.tunnel_id << list(ids)).execute()
+
+    def desired_containers(self):
+        '''
+        containers that should exist, and whether they should run
+
+        a tunnel without state row (created before desired states were kept)
+        is not managed, neither the supervisor nor the reconciler touch its
+        container until it is started, stopped or rebuilt through the api
+        '''
+        states = dict((state.tunnel_id, state) for state in TunnelState.select())
+        desired = {}
+        for tunnel in Tunnel.select():
+            state = states.get(tunnel.id)
+            if (state and state.desired == 'stopped' and
+                    self.packed(self.get_ngrok_config(tunnel))):
+                # the shared container does not serve it, see shard_rows()
+                continue
+            want = desired.setdefault(self.container_name(tunnel), {
+                'ids': [], 'running': False, 'managed': False, 'failures': 0,
+                'next_attempt': 0, 'starttime': 0})
+            want['ids'].append(tunnel.id)
+            want['starttime'] = max(want['starttime'], tunnel.starttime)
+            if state is None:
+                continue
+            want['managed'] = True
+            if state.desired == 'running':
+                want['running'] = True
+            want['failures'] = max(want['failures'], state.failures)
+            want['next_attempt'] = max(want['next_attempt'], state.next_attempt)
+        return desired
+
+    def restart_failed(self, ids, reason):
+        '''
+        restart a container that should run but failed
+
+        restarts are spread out with jittered exponential backoff and stop
+        after restart_budget consecutive failures, cached results are only
+        dropped when a restart happens
+        '''
+        now = time.time()
+        states = list(self.tunnel_states(ids).values())
+        failures = max(state.failures for state in states)
+        next_attempt = max(state.next_attempt for state in states)
+
+        def save(**fields):
+            TunnelState.update(last_failure=reason, **fields).where(
+                TunnelState.tunnel_id << list(ids)).execute()
+
+        if failures >= self.restart_budget:
+            raise TunnelManagerError(None, 'restart budget exhausted')
+        if not next_attempt:
+            # first time we see it, do not restart every tunnel at once
+            save(next_attempt=now + random.uniform(0, self.restart_backoff))
+            return 'scheduled'
+        if now < next_attempt:
+            return 'backoff'
+
+        delay = min(self.restart_max_backoff, self.restart_backoff * 2 ** failures)
+        self.cache.invalidate()
+        try:
+            save(failures=failures + 1,
+                 restarts=max(state.restarts for state in states) + 1,
+                 next_attempt=now + random.uniform(delay / 2, delay))
+
+            tunnel = self.update_tunnel_start_time(ids[0])
+            tunnel_instance = self.get_tunnel_instance(tunnel)
+            if not tunnel_instance.exists():
+                self.apply(ids[0])
+            else:
+                tunnel_instance.restart()
+                self.refresh(tunnel_instance)
+            return 'restarted'
+        finally:
+            self.cache.invalidate()
+
+    def supervise(self):
+        '''
+        one pass over the tunnels that should run, restart the failed ones
+        '''
+        now = time.time()
+        snapshot = self.snapshot()
+        tunnels = dict((tunnel.id, tunnel) for tunnel in Tunnel.select())
+
+        results = {}
+        for name, want in self.desired_containers().items():
+            container = snapshot.get(name)
+            # missing containers are recreated by the reconciler
+            if not want['running'] or container is None:
+                continue
+
+            reason = None
+            state = container.get('State')
+            if state in ('exited', 'dead'):
+                exit_code = ContainerWatcher.from_container(container)['ExitCode']
+                if container.get('ExitCode') is not None:
+                    exit_code = container.get('ExitCode')
+                reason = 'exited with code {0}'.format(exit_code)
+            elif state == 'running':
+                rows = [tunnels[id] for id in want['ids'] if id in tunnels]
+                if not rows or now - rows[0].starttime < self.establish_deadline:
+                    continue
+                if want['failures'] >= self.restart_budget or now < want['next_attempt']:
+                    # nothing would be done, spare the log scan
+                    continue
+                established = False
+                for row in rows:
+                    tunnel_instance = self.get_tunnel_instance(row, snapshot=snapshot)
+                    info = self.get_tunnel_status(row, tunnel_instance)
+                    if info and info['url']:
+                        established = True
+                        break
+                if not established:
+                    reason = 'not established within {0}s'.format(self.establish_deadline)
+            else:
+                continue
+
+            if reason is None:
+                if want['failures'] or want['next_attempt']:
+                    # healthy again
+                    self.reset_failures(want['ids'])
+                continue
+            try:
+                results[name] = self.restart_failed(want['ids'], reason)
+            except TunnelManagerError as e:
+                results[name] = e.message
+            except Exception as e:
+                results[name] = str(e)
+        return results
+
+    def reconcile(self):
+        report = self.reconciler.run()
+        if report is None:
+            raise TunnelManagerError(None, 'reconcile already running')
+        return report
+
+    def reconcile_report(self):
+        return self.reconciler.report()
+
+    def clear_tunnel_mapping(self, *ids):
+        TunnelMapping.delete().where(TunnelMapping.tunnel_id << list(ids)).execute()
+
+    def clear_tunnel_state(self, id):
+        TunnelState.delete().where(TunnelState.tunnel_id == id).execute()
+        TunnelAttempt.delete().where(TunnelAttempt.tunnel_id == id).execute()
+
+    def load_mappings(self, snapshot):
+        '''
+        stored mappings of the running containers, in one query
+        '''
+        container_ids = [container.get('Id') for container in snapshot.values()
+                         if container.get('State') == 'running']
+        mappings = {}
+        if not container_ids:
+            return mappings
+        for mapping in TunnelMapping.select().where(
+                TunnelMapping.container_id << container_ids):
+            mappings[(mapping.tunnel_id, mapping.container_id, mapping.starttime)] = mapping
+        return mappings
+
+    def unmapped(self, snapshot, ids=None):
+        '''
+        running tunnels without stored mapping, their logs need a scan:
+        (tunnel id, container id, start time, shard member config)
+        '''
+        query = Tunnel.select()
+        if ids is not None:
+            query = query.where(Tunnel.id << list(ids))
+        tunnels = list(query)
+        shards = self.group_shards(tunnels) if ids is None else None
+        mappings = self.load_mappings(snapshot)
+
+        result = []
+        for tunnel in tunnels:
+            tunnel_instance = self.get_tunnel_instance(
+                tunnel, snapshot=snapshot, shards=shards)
+            container = tunnel_instance.container()
+            if not container or container.get('State') != 'running':
+                continue
+            if (tunnel.id, container.get('Id'), tunnel.starttime) in mappings:
+                continue
+            result.append((tunnel.id, container.get('Id'),
+                           tunnel_instance.start_time, tunnel_instance.member))
+        return result
+
+    def get_tunnel_status(self, tunnel, tunnel_instance, mappings=None, scanned=None):
+        '''
+        status of a tunnel, only scan the log when no mapping is stored
+
+        mappings from load_mappings() saves the query per tunnel, scanned
+        holds the scan results of unmapped() tunnels read by the caller
+        '''
+        container = tunnel_instance.container()
+        if not container or container.get('State') != 'running':
+            return None
+
+        container_id = container.get('Id')
+        if mappings is not None:
+            mapping = mappings.get((tunnel.id, container_id, tunnel.starttime))
+        else:
+            mapping = TunnelMapping.select().where(
+                (TunnelMapping.tunnel_id == tunnel.id) &
+                (TunnelMapping.container_id == container_id) &
+                (TunnelMapping.starttime == tunnel.starttime)).first()
+        if mapping:
+            return mapping_to_dict(mapping)
+
+        if scanned is not None:
+            info, established_at = scanned.get(tunnel.id) or (Ngrok.parse_mapping(''), None)
+        else:
+            # the instance rechecks the state, reuse the container we already have
+            if tunnel_instance.snapshot is None:
+                tunnel_instance.snapshot = {tunnel_instance.name: container}
+            info, established_at = tunnel_instance.scan_status()
+        if info and info['url']:
+            if established_at:
+                self.record_established(tunnel, established_at)
+            try:
+                TunnelMapping.create(
+                    tunnel_id=tunnel.id,
+                    container_id=container_id,
+                    starttime=tunnel.starttime,
+                    **info
+                )
+            except peewee.IntegrityError:
+                # stored by a concurrent request
+                pass
+        return info
+
+    def tunnel_to_dict(self, tunnel, tunnel_instance, tunnel_state=None,
+                       mappings=None, scanned=None):
+        tunnel_dict = tunnel_to_dict(tunnel)
+        tunnel_dict['state'] = tunnel_instance.state()
+        tunnel_dict['status'] = self.get_tunnel_status(
+            tunnel, tunnel_instance, mappings, scanned)
+        tunnel_dict['exists'] = tunnel_instance.exists()
+        tunnel_dict['supervision'] = state_to_dict(tunnel_state)
+        return tunnel_dict
+
     def list(self):
+        return self.cache.get('list', self.list_uncached)
+
+    def list_uncached(self, snapshot=None, scanned=None):
+        # one docker query for all tunnels instead of several per tunnel
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        tunnels = list(Tunnel.select().order_by(Tunnel.id))
+        shards = self.group_shards(tunnels)
+
+        states = dict((state.tunnel_id, state) for state in TunnelState.select())
+        mappings = self.load_mappings(snapshot)
+
         tunnel_dicts = []
-        for tunnel in Tunnel.select():
-            tunnel_dict = self.get(tunnel.id)
-            tunnel_dicts.append(tunnel_dict)
+        for tunnel in tunnels:
+            tunnel_instance = self.get_tunnel_instance(
+                tunnel, snapshot=snapshot, shards=shards)
+            tunnel_dicts.append(self.tunnel_to_dict(
+                tunnel, tunnel_instance, states.get(tunnel.id), mappings, scanned))
 
         return tunnel_dicts
 
+    def count_by_state(self):
+        '''
+        number of tunnels per container state, None when no container
+        '''
+        snapshot = self.snapshot()
+        counts = {}
+        for tunnel in Tunnel.select():
+            container = snapshot.get(self.container_name(tunnel))
+            state = container.get('State') if container else None
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
     def get(self, id):
+        return self.cache.get('tunnel-{0}'.format(id), lambda: self.get_uncached(id))
+
+    def get_uncached(self, id, snapshot=None, scanned=None):
         try:
             tunnel = Tunnel.get(Tunnel.id == id)
-            tunnel_instance = self.get_tunnel_instance(tunnel)
+            tunnel_instance = self.get_tunnel_instance(tunnel, snapshot=snapshot)
+            if tunnel_instance.snapshot is None:
+                # take a snapshot of this container only
+                tunnel_instance.snapshot = self.snapshot(name=tunnel_instance.name)
+            tunnel_state = TunnelState.select().where(
+                TunnelState.tunnel_id == tunnel.id).first()
+
+            return self.tunnel_to_dict(
+                tunnel, tunnel_instance, tunnel_state, scanned=scanned)
+        except peewee.DoesNotExist as e:
+            raise TunnelManagerError(e, 'id does not exist in db')
 
-            tunnel_dict = tunnel_to_dict(tunnel)
-            tunnel_dict['state'] = tunnel_instance.state()
-            tunnel_dict['status'] = tunnel_instance.status()
-            tunnel_dict['exists'] = tunnel_instance.exists()
+    def status(self, id, snapshot=None, scanned=None):
+        try:
+            tunnel = Tunnel.get(Tunnel.id == id)
+            tunnel_instance = self.get_tunnel_instance(tunnel, snapshot=snapshot)
+            if tunnel_instance.snapshot is None:
+                tunnel_instance.snapshot = self.snapshot(name=tunnel_instance.name)
+            return self.get_tunnel_status(tunnel, tunnel_instance, scanned=scanned)
+        except peewee.DoesNotExist as e:
+            raise TunnelManagerError(e, 'id does not exist in db')
 
-            return tunnel_dict
+    def stats(self, id, minutes=60):
+        '''
+        connection events of the container of a tunnel, per minute
+        '''
+        try:
+            tunnel = Tunnel.get(Tunnel.id == id)
         except peewee.DoesNotExist as e:
             raise TunnelManagerError(e, 'id does not exist in db')
+        minutes = max(1, min(int(minutes), BUCKETS))
+        result = TrafficIngester.stats(self.container_name(tunnel), minutes)
+        # a shared container counts the events of all its tunnels
+        result['shared'] = len(self.container_rows(tunnel)) > 1
+        return result
+
+    def log(self, id, cursor=None, offset=0, limit=10, tail=None):
+        try:
+            tunnel_instance = self.get_tunnel_instance_by_id(id)
+            return tunnel_instance.log(
+                cursor=cursor, offset=offset, limit=limit, tail=tail)
+        except peewee.DoesNotExist as e:
+            raise TunnelManagerError(e, 'id does not exist in db')
+
+    def stream(self, id, heartbeat=15):
+        '''
+        current status, then new log lines and status changes as they come
+        '''
+        try:
+            tunnel_instance = self.get_tunnel_instance_by_id(id)
+        except peewee.DoesNotExist as e:
+            raise TunnelManagerError(e, 'id does not exist in db')
+
+        yield 'status', self.status(id)
+        if tunnel_instance.state() != 'running':
+            return
+
+        q = self.log_broker.subscribe(tunnel_instance)
+        try:
+            while True:
+                try:
+                    event, data = q.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield 'heartbeat', None
+                    continue
+                if event == 'end':
+                    return
+                # a shared container reports the tunnels of its neighbours too
+                if (event == 'status' and data and tunnel_instance.member and
+                        not tunnel_instance.member.matches(data['url'])):
+                    continue
+                yield event, data
+        finally:
+            self.log_broker.unsubscribe(tunnel_instance, q)
+
+    def stream_many(self, ids, heartbeat=15):
+        '''
+        stream() of several tunnels over one connection, the data of every
+        event but heartbeats is {'id': tunnel id, 'data': data}
+        '''
+        instances = []
+        for id in ids:
+            try:
+                instances.append((id, self.get_tunnel_instance_by_id(id)))
+            except peewee.DoesNotExist as e:
+                raise TunnelManagerError(e, 'id {0} does not exist in db'.format(id))
 
+        q = queue.Queue()
+        subscribed = {}
+        try:
+            for id, tunnel_instance in instances:
+                yield 'status', {'id': id, 'data': self.status(id)}
+                if tunnel_instance.state() == 'running':
+                    tagged = TaggedQueue(q, id)
+                    self.log_broker.subscribe(tunnel_instance, tagged)
+                    subscribed[id] = (tunnel_instance, tagged)
+
+            while subscribed:
+                try:
+                    id, event, data = q.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield 'heartbeat', None
+                    continue
+                if id not in subscribed:
+                    continue
+                tunnel_instance = subscribed[id][0]
+                if event == 'end':
+                    self.log_broker.unsubscribe(*subscribed.pop(id))
+                    yield 'end', {'id': id, 'data': None}
+                    continue
+                if (event == 'status' and data and tunnel_instance.member and
+                        not tunnel_instance.member.matches(data['url'])):
+                    continue
+                yield event, {'id': id, 'data': data}
+        finally:
+            for tunnel_instance, tagged in subscribed.values():
+                self.log_broker.unsubscribe(tunnel_instance, tagged)
+
+    @invalidates
     def start(self, id):
         try:
+            tunnel = Tunnel.get(Tunnel.id == id)
+            if self.packed(self.get_ngrok_config(tunnel)):
+                # join the shared container again, its other tunnels keep going
+                self.set_desired([tunnel.id], 'running')
+                self.reload_shard(self.shard_of(tunnel.id))
+                return self.get_uncached(id)
+
             # update starttime
             tunnel = self.update_tunnel_start_time(id)
             tunnel_instance = self.get_tunnel_instance(tunnel)
+            self.set_desired([tunnel.id], 'running')
             if tunnel_instance.exists():
                 tunnel_instance.start()
-                return self.get(id)
+                self.refresh(tunnel_instance)
+                return self.get_uncached(id)
             else:
                 raise TunnelManagerError(None, 'container no exists')
         except peewee.DoesNotExist as e:
             raise TunnelManagerError(e, 'id does not exist in db')
 
+    @invalidates
     def stop(self, id):
         try:
-            tunnel_instance = self.get_tunnel_instance_by_id(id)
+            tunnel = Tunnel.get(Tunnel.id == id)
+            if self.packed(self.get_ngrok_config(tunnel)):
+                # leave the shared container, its other tunnels keep going
+                self.set_desired([tunnel.id], 'stopped')
+                self.clear_tunnel_mapping(tunnel.id)
+                self.reload_shard(self.shard_of(tunnel.id))
+                return self.get_uncached(id)
+
+            tunnel_instance = self.get_tunnel_instance(tunnel)
+            self.set_desired([tunnel.id], 'stopped')
             if tunnel_instance.exists():
                 tunnel_instance.stop()
-                return self.get(id)
+                self.refresh(tunnel_instance)
+                return self.get_uncached(id)
             else:
                 raise TunnelManagerError(None, 'container no exists')
         except peewee.DoesNotExist as e:
             raise TunnelManagerError(e, 'id does not exist in db')
 
-    def rebuild(self, id):
+    @invalidates
+    def rebuild(self, id, progress=None):
         try:
+            tunnel = Tunnel.get(Tunnel.id == id)
+            if self.packed(self.get_ngrok_config(tunnel)):
+                # rewrite our part of the shared container, do not recreate it
+                self.set_desired([tunnel.id], 'running')
+                self.reload_shard(self.shard_of(tunnel.id), progress=progress)
+                return self.get_uncached(id)
+
             # update starttime
             tunnel = self.update_tunnel_start_time(id)
             tunnel_instance = self.get_tunnel_instance(tunnel)
+            self.set_desired([tunnel.id], 'running')
             if tunnel_instance.exists():
                 tunnel_instance.down()
-            tunnel_instance.up()
+            # same as up(), reporting each step
+            tunnel_instance.create()
+            if progress:
+                progress('created')
+            tunnel_instance.start()
+            if progress:
+                progress('started')
+            self.refresh(tunnel_instance)
 
-            return self.get(id)
+            return self.get_uncached(id)
         except peewee.DoesNotExist as e:
             raise TunnelManagerError(e, 'id does not exist in db')
 
+    @invalidates
     def remove(self, id):
         try:
             tunnel = Tunnel.get(Tunnel.id == id)
             tunnel_instance = self.get_tunnel_instance(tunnel)
+            if tunnel_instance.member:
+                # keep the container, serve the other tunnels of the shard
+                tunnel.delete_instance()
+                self.clear_tunnel_mapping(id)
+                self.clear_tunnel_state(id)
+                self.reload_shard(self.shard_of(id))
+                return
             if tunnel_instance.exists():
                 tunnel_instance.down()
+                self.refresh(tunnel_instance)
             tunnel.delete_instance()
+            self.clear_tunnel_mapping(id)
+            self.clear_tunnel_state(id)
 
         except peewee.DoesNotExist as e:
             raise TunnelManagerError(e, 'id does not exist in db')
 
+    @invalidates
+    def reload_shard(self, shard, progress=None):
+        '''
+        rewrite the config of a shared container and restart only it
+        '''
+        rows = self.shard_rows(shard)
+        tunnel_instance = Ngrok(
+            self.docker_cli, self.get_shard_config(shard, rows), pool=self.pool)
+        if not rows:
+            # nothing left to serve
+            if tunnel_instance.exists():
+                tunnel_instance.down()
+                self.refresh(tunnel_instance)
+            return
+
+        tunnel = self.update_tunnel_start_time(rows[0].id)
+        tunnel_instance.start_time = tunnel.starttime
+        self.set_desired([row.id for row in rows], 'running')
+        if tunnel_instance.exists():
+            tunnel_instance.init_config_file()
+            if progress:
+                progress('created')
+            tunnel_instance.restart()
+        else:
+            tunnel_instance.create()
+            if progress:
+                progress('created')
+            tunnel_instance.start()
+        if progress:
+            progress('started')
+        self.refresh(tunnel_instance)
+
+    @invalidates
+    def apply(self, id, progress=None):
+        '''
+        bring the container of a new or changed tunnel up
+        '''
+        tunnel = Tunnel.get(Tunnel.id == id)
+        if self.packed(self.get_ngrok_config(tunnel)):
+            self.reload_shard(self.shard_of(id), progress=progress)
+        else:
+            self.rebuild(id, progress=progress)
+
     def clear(self):
-        for tunnel in Tunnel.select():
-            self.remove(tunnel.id)
+        return self.bulk('remove')
 
-    def create(self, tunnel_dict):
-        try:
-            print(tunnel_dict)
+    def bulk(self, action, ids=None):
+        '''
+        run an action on many tunnels in parallel, result per tunnel id
+        '''
+        actions = {
+            'start': self.start,
+            'stop': self.stop,
+            'rebuild': self.rebuild,
+            'remove': self.remove
+        }
+        if action not in actions:
+            raise TunnelManagerError(None, 'unknown action')
+        func = actions[action]
 
-            # check
-            t_name = tunnel_dict.get('name', '')
-            t_localaddr = tunnel_dict.get('localaddr', '')
-            t_remoteport = tunnel_dict.get('remoteport', '')
-            t_proto = tunnel_dict.get('proto', '')
-            t_auth = tunnel_dict.get('auth', '')
-            t_hostname = tunnel_dict.get('hostname', '')
+        if ids is None:
+            ids = [tunnel.id for tunnel in Tunnel.select(Tunnel.id)]
 
-            if (not t_name) or (not t_localaddr) or (not t_proto):
-               raise TunnelManagerError(None, 'need tunnel name, localaddr, proto')
+        def run(id):
+            try:
+                return {'data': func(id), 'error': 0}
+            except TunnelManagerError as e:
+                return {'data': None, 'error': 1, 'msg': e.message}
+            except Exception as e:
+                return {'data': None, 'error': 1, 'msg': str(e)}
 
-            new = Tunnel(
-                name = t_name,
-                localaddr = t_localaddr,
-                remoteport = t_remoteport,
-                proto = t_proto,
-                auth = t_auth,
-                hostname = t_hostname,
-                starttime = 0
-            )
+        def run_group(group):
+            return [(id, run(id)) for id in group]
+
+        # tunnels sharing a container are handled one after another
+        groups = {}
+        for id in ids:
+            try:
+                key = self.get_tunnel_instance_by_id(id).name
+            except peewee.DoesNotExist:
+                key = id
+            groups.setdefault(key, []).append(id)
+
+        results = {}
+        if not groups:
+            return results
+        with ThreadPoolExecutor(max_workers=self.bulk_workers) as pool:
+            for group_results in pool.map(run_group, groups.values()):
+                results.update(group_results)
+        return results
+
+    def check(self, tunnel_dict):
+        '''
+        fields of a new tunnel, raise when they are not usable
+        '''
+        t_name = tunnel_dict.get('name', '')
+        t_localaddr = tunnel_dict.get('localaddr', '')
+        t_remoteport = tunnel_dict.get('remoteport', '')
+        t_proto = tunnel_dict.get('proto', '')
+        t_auth = tunnel_dict.get('auth', '')
+        t_hostname = tunnel_dict.get('hostname', '')
+
+        if (not t_name) or (not t_localaddr) or (not t_proto):
+           raise TunnelManagerError(None, 'need tunnel name, localaddr, proto')
+        if t_name.startswith('_'):
+           raise TunnelManagerError(None, 'tunnel name can not start with _')
+
+        return {
+            'name': t_name,
+            'localaddr': t_localaddr,
+            'remoteport': t_remoteport,
+            'proto': t_proto,
+            'auth': t_auth,
+            'hostname': t_hostname,
+            'starttime': 0
+        }
+
+    def insert(self, tunnel_dict):
+        '''
+        check and save a new tunnel, without creating its container
+        '''
+        try:
+            print(tunnel_dict)
+
+            new = Tunnel(**self.check(tunnel_dict))
             # insert new tunnel into db
             new.save()
-            # create new tunnel instance
-            # if already exist, then rebuild(down and up)
-            self.rebuild(new.id)
+            return new
+        except peewee.IntegrityError as e:
+            raise TunnelManagerError(e, 'tunnel name should be UNIQUE in db')
+
+    def insert_batch(self, tunnel_dicts):
+        '''
+        check every tunnel first, then save all of them or none
+        '''
+        if not isinstance(tunnel_dicts, list) or not tunnel_dicts:
+            raise TunnelManagerError(None, 'need a list of tunnels')
+
+        rows, errors, names = [], [], set()
+        for i, tunnel_dict in enumerate(tunnel_dicts):
+            try:
+                if not isinstance(tunnel_dict, dict):
+                    raise TunnelManagerError(None, 'tunnel must be an object')
+                row = self.check(tunnel_dict)
+                if row['name'] in names:
+                    raise TunnelManagerError(None, 'tunnel name repeated in batch')
+                names.add(row['name'])
+                rows.append(row)
+            except TunnelManagerError as e:
+                errors.append('tunnel {0}: {1}'.format(i, e.message))
+        if errors:
+            raise TunnelManagerError(None, '; '.join(errors))
 
-            return self.get(new.id)
+        try:
+            with db.atomic():
+                taken = [tunnel.name for tunnel in
+                         Tunnel.select(Tunnel.name).where(Tunnel.name << list(names))]
+                if taken:
+                    raise TunnelManagerError(
+                        None, 'tunnel name should be UNIQUE in db: ' + ', '.join(sorted(taken)))
+                # 7 columns a row, stay below the sqlite limit of 999 variables
+                for i in range(0, len(rows), 100):
+                    Tunnel.insert_many(rows[i:i + 100]).execute()
+                return list(Tunnel.select().where(Tunnel.name << list(names)).order_by(Tunnel.id))
         except peewee.IntegrityError as e:
             raise TunnelManagerError(e, 'tunnel name should be UNIQUE in db')
 
+    @invalidates
+    def create_batch(self, tunnel_dicts):
+        '''
+        save many tunnels in one transaction and bring their containers up
+        in parallel, every shared container is reloaded once
+        '''
+        rows = self.insert_batch(tunnel_dicts)
+
+        units = {}
+        for row in rows:
+            if self.packed(self.get_ngrok_config(row)):
+                shard = self.shard_of(row.id)
+                units.setdefault(('shard', shard), []).append(row.id)
+            else:
+                units[row.id] = [row.id]
+
+        def run(key):
+            try:
+                if isinstance(key, tuple):
+                    self.reload_shard(key[1])
+                else:
+                    self.rebuild(key)
+                return None
+            except TunnelManagerError as e:
+                return e.message
+            except Exception as e:
+                return str(e)
+
+        with ThreadPoolExecutor(max_workers=self.bulk_workers) as pool:
+            failures = dict(zip(units.keys(), pool.map(run, units.keys())))
+
+        # only the new tunnels, from one snapshot
+        snapshot = self.snapshot()
+        tunnels = {}
+        for row in rows:
+            try:
+                tunnels[row.id] = self.get_uncached(row.id, snapshot)
+            except TunnelManagerError:
+                # removed in the meantime
+                tunnels[row.id] = None
+        results = {}
+        for key, ids in units.items():
+            for id in ids:
+                if failures[key]:
+                    results[id] = {'data': tunnels.get(id), 'error': 1, 'msg': failures[key]}
+                else:
+                    results[id] = {'data': tunnels.get(id), 'error': 0}
+        return results
+
+    def export(self):
+        '''
+        every tunnel in the shape create_batch takes
+        '''
+        keys = ('name', 'hostname', 'localaddr', 'remoteport', 'proto', 'auth')
+        return [dict((key, getattr(tunnel, key)) for key in keys)
+                for tunnel in Tunnel.select().order_by(Tunnel.id)]
+
+    @invalidates
+    def create(self, tunnel_dict):
+        new = self.insert(tunnel_dict)
+        # create new tunnel instance
+        # if already exist, then rebuild(down and up)
+        self.apply(new.id)
+
+        return self.get_uncached(new.id)
+
+    def create_async(self, tunnel_dict):
+        '''
+        save the tunnel and bring it up in the background, return the job
+        '''
+        new = self.insert(tunnel_dict)
+        job = self.jobs.submit(new.id, lambda progress: self.rebuild_job(new.id, progress))
+        return job_to_dict(job)
+
+    def rebuild_job(self, id, progress):
+        self.apply(id, progress=progress)
+
+        # wait for the tunnel to be established
+        tunnel_dict, lines = self.wait(id, self.job_timeout)
+        status = tunnel_dict['status']
+        if status and status['url']:
+            progress('established', url=status['url'], done=True)
+        else:
+            progress('started', msg='tunnel not established yet', done=True)
+
+    def wait(self, id, timeout):
+        '''
+        block until the tunnel is established or timeout, following one
+        log stream, return the tunnel and the last log lines on timeout
+        '''
+        try:
+            tunnel = Tunnel.get(Tunnel.id == id)
+            tunnel_instance = self.get_tunnel_instance(tunnel)
+            info, lines = tunnel_instance.wait_established(timeout)
+            if info:
+                lines = None
+            return self.get_uncached(id), lines
+        except peewee.DoesNotExist as e:
+            raise TunnelManagerError(e, 'id does not exist in db')
+
+    def get_job(self, job_id):
+        try:
+            return job_to_dict(Job.get(Job.uuid == job_id))
+        except peewee.DoesNotExist as e:
+            raise TunnelManagerError(e, 'job does not exist')
+
+    @invalidates
     def update(self, id, tunnel_dict):
         try:
             print(tunnel_dict)
 
-            # check
-            t_name = tunnel_dict.get('name', '')
-            t_localaddr = tunnel_dict.get('localaddr', '')
-            t_remoteport = tunnel_dict.get('remoteport', '')
-            t_proto = tunnel_dict.get('proto', '')
-            t_auth = tunnel_dict.get('auth', '')
-            t_hostname = tunnel_dict.get('hostname', '')
+            tunnel = Tunnel.get(Tunnel.id == id)
+
+            # check, missing fields keep their current value
+            t_name = tunnel_dict.get('name', tunnel.name)
+            t_localaddr = tunnel_dict.get('localaddr', tunnel.localaddr)
+            t_remoteport = tunnel_dict.get('remoteport', tunnel.remoteport)
+            t_proto = tunnel_dict.get('proto', tunnel.proto)
+            t_auth = tunnel_dict.get('auth', tunnel.auth)
+            t_hostname = tunnel_dict.get('hostname', tunnel.hostname)
 
             if (not t_name) or (not t_localaddr) or (not t_proto):
                raise TunnelManagerError(None, 'need tunnel name, localaddr, proto')
+            if t_name.startswith('_'):
+               raise TunnelManagerError(None, 'tunnel name can not start with _')
 
-            # remove old tunnel instance
-            tunnel = Tunnel.get(Tunnel.id == id)
-            tunnel_instance = self.get_tunnel_instance(tunnel)
-            if tunnel_instance.exists():
-                tunnel_instance.down()
+            old_fields = (tunnel.name, tunnel.localaddr, tunnel.remoteport,
+                          tunnel.proto, tunnel.auth, tunnel.hostname)
+            new_fields = (t_name, t_localaddr, t_remoteport,
+                          t_proto, t_auth, t_hostname)
+            if new_fields == old_fields:
+                # nothing changed
+                return self.get_uncached(id)
+
+            old_config = self.get_ngrok_config(tunnel)
+            old_instance = self.get_tunnel_instance(tunnel)
 
             # update new tunnel
             tunnel.name = t_name
@@ -173,16 +1071,105 @@ class NgrokManager:
             tunnel.proto = t_proto
             tunnel.auth = t_auth
             tunnel.hostname = t_hostname
+
+            new_config = self.get_ngrok_config(tunnel)
+            if new_config.dump() == old_config.dump():
+                # the container does not see this change
+                tunnel.save()
+                return self.get_uncached(id)
+
+            new_instance = self.get_tunnel_instance(tunnel)
+            if new_instance.name == old_instance.name and old_instance.exists():
+                # same container, only its config changes
+                tunnel.save()
+                if new_instance.member:
+                    self.reload_shard(self.shard_of(id))
+                elif old_instance.state() == 'running':
+                    self.update_tunnel_start_time(id)
+                    new_instance.init_config_file()
+                    new_instance.restart()
+                    self.refresh(new_instance)
+                else:
+                    # a stopped tunnel stays stopped, start() reads the new config
+                    new_instance.init_config_file()
+                return self.get_uncached(id)
+
+            # remove old tunnel instance
+            if not old_instance.member and old_instance.exists():
+                old_instance.down()
+                self.refresh(old_instance)
+
             tunnel.starttime = 0
             # update
             tunnel.save()
+            self.clear_tunnel_mapping(id)
 
+            # a shared container is reloaded, with or without this tunnel
+            new_instance = self.get_tunnel_instance(tunnel)
+            if old_instance.member or new_instance.member:
+                self.reload_shard(self.shard_of(id))
             # create new tunnel instance
             # if already exist, then rebuild(down and up)
-            self.rebuild(id)
+            if not new_instance.member:
+                self.rebuild(id)
 
-            return self.get(id)
+            return self.get_uncached(id)
         except peewee.DoesNotExist as e:
             raise TunnelManagerError(e, 'id does not exist in db')
         except peewee.IntegrityError as e:
             raise TunnelManagerError(e, 'tunnel name should be UNIQUE in db')
+
+
+def percentile(values, p):
+    '''
+    nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+
+def tunnels_from_yaml(data):
+    '''
+    tunnel dicts of a ngrok config like doc/demo.yml, name is the subdomain
+    '''
+    tunnels = data.get('tunnels') if isinstance(data, dict) else None
+    if not isinstance(tunnels, dict):
+        raise TunnelManagerError(None, 'need a tunnels mapping')
+
+    result = []
+    for key, port_map in tunnels.items():
+        port_map = port_map if isinstance(port_map, dict) else {}
+        proto = port_map.get('proto')
+        proto, localaddr = list(proto.items())[0] if isinstance(proto, dict) and proto else ('', '')
+        remote_port = port_map.get('remote_port')
+        result.append({
+            'name': port_map.get('subdomain') or key,
+            'hostname': port_map.get('hostname') or '',
+            'localaddr': str(localaddr),
+            'remoteport': str(remote_port) if remote_port else '',
+            'proto': proto,
+            'auth': port_map.get('auth') or ''
+        })
+    return result
+
+
+def tunnels_to_yaml(tunnel_dicts):
+    '''
+    the opposite of tunnels_from_yaml
+    '''
+    tunnels = {}
+    for tunnel_dict in tunnel_dicts:
+        port_map = {
+            'proto': {tunnel_dict['proto']: tunnel_dict['localaddr']},
+            'subdomain': tunnel_dict['name'],
+            'auth': tunnel_dict['auth']
+        }
+        remote_port = str(tunnel_dict['remoteport'])
+        if remote_port:
+            port_map['remote_port'] = int(remote_port) if remote_port.isdigit() else remote_port
+        if tunnel_dict['hostname']:
+            port_map['hostname'] = tunnel_dict['hostname']
+        tunnels[tunnel_dict['name']] = port_map
+    return {'tunnels': tunnels}
@@ -1,14 +1,23 @@
+from urllib.parse import urlsplit
 import yaml
+import calendar
+import collections
+import hashlib
+import json
 import os
 import re
+import threading
+import time
 
-from config import get_config
+from config import get_config, get_config_bool, get_config_int
+from core.atomicfile import write_atomic
+from core.dockerclient import close_stream
 from core.error import TunnelInstanceError
 
 
 class Ngrok:
 
-    def __init__(self, docker_cli, config, start_time=0):
+    def __init__(self, docker_cli, config, start_time=0, snapshot=None, member=None, pool=None):
         self.cli = docker_cli
         self.config = config
         self.name = 'ngrok_' + config.name + '_'
@@ -18,11 +27,25 @@ class Ngrok:
         self.ports = config.ports()
 
         self.start_time = start_time
-
-    def id(self):
+        # containers indexed by name, see NgrokManager.snapshot()
+        self.snapshot = snapshot
+        # config of our tunnel when the container serves several tunnels
+        self.member = member
+        # warm pool to take a ready container from, see core/warmpool.py
+        self.pool = pool
+
+    def container(self):
+        if self.snapshot is not None:
+            return self.snapshot.get(self.name)
         res = self.cli.containers(all=True, filters={'name': self.name})
         if len(res) > 0:
-            return res[0].get('Id')
+            return res[0]
+        return None
+
+    def id(self):
+        container = self.container()
+        if container:
+            return container.get('Id')
         return None
 
     def exists(self):
@@ -32,26 +55,64 @@ class Ngrok:
         return False
 
     def state(self):
-        res = self.cli.containers(all=True, filters={'name': self.name})
-        if len(res) > 0:
-            return res[0].get('State')
+        container = self.container()
+        if container:
+            return container.get('State')
         return None
 
-    def status(self):
+    def scan_status(self):
+        '''
+        status and the time (in seconds) the tunnel got established
+        '''
         if self.state() != 'running':
-            return None
+            return None, None
 
-        # get maping url
-        mapping = ''
-        regex1 = re.compile(r'^.*Tunnel established at(.*?)$')
+        scan = StatusScan(self.member)
         # fetch log using stream mode
-        for line in self.__log_stream(since=self.start_time):
-            line = line.strip().decode()
-            matched = regex1.search(line)
-            if matched:
-                mapping = matched.group(1).strip()
-                break
-
+        stream = self.log_stream(since=self.start_time)
+        try:
+            for line in split_lines(stream):
+                if scan.feed(line):
+                    break
+        finally:
+            # leaving early leaves the connection of the stream open
+            close_stream(stream)
+        return scan.result()
+
+    def wait_established(self, timeout, keep=20):
+        '''
+        follow the log until the tunnel is established or timeout,
+        return the status (None on timeout) and the last log lines
+        '''
+        deadline = time.time() + timeout
+        last = collections.deque(maxlen=keep)
+        scan = StatusScan(self.member)
+        stream, timer = None, None
+        try:
+            stream = self.log_stream(since=self.start_time, follow=True)
+            # a followed stream has no read timeout, a silent container
+            # would block forever, close the stream at the deadline
+            timer = threading.Timer(max(0, deadline - time.time()), close_stream, (stream,))
+            timer.daemon = True
+            timer.start()
+            for line in split_lines(stream):
+                last.append(line)
+                if scan.feed(line):
+                    return scan.result()[0], list(last)
+                if time.time() > deadline:
+                    break
+        except Exception:
+            # closed at the deadline, or the container went away
+            pass
+        finally:
+            if timer:
+                timer.cancel()
+            if stream is not None:
+                close_stream(stream)
+        return None, list(last)
+
+    @staticmethod
+    def parse_mapping(mapping):
         # get address and port from mapping
         proto = ''
         addr = ''
@@ -83,8 +144,12 @@ class Ngrok:
         ).decode()
         return res
 
-    def __log_stream(self, since=0, tail='all'):
+    def log_stream(self, since=0, tail='all', follow=False):
+        '''
+        raw log chunks, close_stream() ends a followed one from any thread
+        '''
         container_id = self.id()
+        # docker-py follows the log when streaming unless told otherwise
         res = self.cli.logs(
             container=container_id,
             stdout=True,
@@ -92,15 +157,25 @@ class Ngrok:
             timestamps=True,
             tail=tail,
             since=since,
-            stream=True
+            stream=True,
+            follow=follow
         )
         return res
 
-    def log(self, offset=0, limit=10):
-        # set tail to 100, because it may be timeout when log too big
-        res = self.__log(since=self.start_time, tail=100)
-        lines = res.split('\n')
-        return lines[offset:offset+limit]
+    def log(self, cursor=None, offset=0, limit=10, tail=None):
+        '''
+        log lines after cursor, with the cursor to resume from
+        '''
+        page = LogPage(cursor, offset, limit)
+        since, tail = page.since(self.start_time, tail)
+        stream = self.log_stream(since=since, tail=tail)
+        try:
+            for line in split_lines(stream):
+                if page.feed(line):
+                    break
+        finally:
+            close_stream(stream)
+        return page.result()
 
     def init_config_file(self):
         yaml_path = self.config.yaml_path_in_container
@@ -108,16 +183,32 @@ class Ngrok:
         if not os.path.exists(yaml_dir):
             os.mkdir(yaml_dir)
 
-        data = self.config.dump()
-
-        with open(yaml_path, "w") as f:
-            yaml.dump(data, f, default_flow_style=False)
+        write_config_file(yaml_path, self.config.dumps().encode())
 
     def clear_config_file(self):
         yaml_path = self.config.yaml_path_in_container
         if os.path.exists(yaml_path):
             os.remove(yaml_path)
 
+    def link_config_file(self, link_name):
+        '''
+        point the config file a pool container reads to our config file
+        '''
+        yaml_dir, yaml_name = os.path.split(self.config.yaml_path_in_container)
+        link_path = os.path.join(yaml_dir, link_name)
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.symlink(yaml_name, link_path)
+
+    def unlink_config_file(self, container_id):
+        labels = self.cli.inspect_container(container_id)['Config'].get('Labels') or {}
+        link_name = labels.get('ngrok.pool_yaml')
+        if link_name:
+            yaml_dir = os.path.split(self.config.yaml_path_in_container)[0]
+            link_path = os.path.join(yaml_dir, link_name)
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+
     def create(self):
         '''
         create
@@ -127,6 +218,13 @@ class Ngrok:
 
         # init config file
         self.init_config_file()
+        # take a pre-created container when there is one
+        if self.pool:
+            claimed = self.pool.claim(self.name)
+            if claimed:
+                container_id, link_name = claimed
+                self.link_config_file(link_name)
+                return container_id
         # create new container
         container = self.cli.create_container(
             name=self.name,
@@ -149,6 +247,7 @@ class Ngrok:
         # remove the container
         container_id = self.id()
         if container_id:
+            self.unlink_config_file(container_id)
             response = self.cli.remove_container(container=container_id)
             print(response)
             return True
@@ -172,12 +271,24 @@ class Ngrok:
         '''
         container_id = self.id()
         if container_id:
-            response = self.cli.stop(container=container_id)
+            response = self.cli.stop(
+                container=container_id, timeout=self.config.stop_timeout)
             print(response)
             return True
         else:
             raise TunnelInstanceError(None, 'container no exists')
 
+    def restart(self):
+        '''
+        restart
+        '''
+        container_id = self.id()
+        if container_id:
+            self.cli.restart(container=container_id, timeout=self.config.stop_timeout)
+            return True
+        else:
+            raise TunnelInstanceError(None, 'container no exists')
+
     def up(self):
         '''
         create and start
@@ -193,19 +304,192 @@ class Ngrok:
         self.remove()
 
 
+def split_lines(chunks):
+    buf = b''
+    for chunk in chunks:
+        buf += chunk
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            yield line.decode(errors='replace').rstrip('\r')
+    if buf:
+        yield buf.decode(errors='replace').rstrip('\r')
+
+
+def parse_timestamp(line):
+    '''
+    nanoseconds of the RFC3339 timestamp docker puts in front of a line
+    '''
+    ts = line.split(' ', 1)[0]
+    try:
+        seconds = calendar.timegm(time.strptime(ts[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return 0
+    fraction = ts[19:].rstrip('Z')
+    nanos = 0
+    if fraction.startswith('.'):
+        nanos = int(fraction[1:10].ljust(9, '0'))
+    return seconds * 10**9 + nanos
+
+
+def encode_cursor(ts, seen):
+    return '{0:x}-{1:x}'.format(ts, seen)
+
+
+def decode_cursor(cursor):
+    try:
+        ts, seen = cursor.split('-', 1)
+        return int(ts, 16), int(seen, 16)
+    except ValueError:
+        return 0, 0
+
+
+class StatusScan:
+    '''
+    look for the "Tunnel established at" line of a tunnel in its log
+    '''
+
+    regex = re.compile(r'^.*Tunnel established at(.*?)$')
+
+    def __init__(self, member=None):
+        self.member = member
+        self.mapping = ''
+        self.established_at = None
+
+    def feed(self, line):
+        '''
+        take the next line, return True once the tunnel is found
+        '''
+        matched = self.regex.search(line)
+        if not matched:
+            return False
+        url = matched.group(1).strip()
+        if self.member and not self.member.matches(url):
+            return False
+        self.mapping = url
+        self.established_at = parse_timestamp(line) / 10.0**9 or None
+        return True
+
+    def result(self):
+        '''
+        status and the time (in seconds) the tunnel got established
+        '''
+        return Ngrok.parse_mapping(self.mapping), self.established_at
+
+
+class LogPage:
+    '''
+    one page of log lines read from a cursor
+
+    lines skipped by offset move the cursor too, the returned cursor always
+    resumes right after the last line read
+    '''
+
+    def __init__(self, cursor, offset, limit):
+        self.cursor = cursor
+        self.last_ts, self.seen = decode_cursor(cursor) if cursor else (0, 0)
+        # lines of last_ts the cursor already covers
+        self.replay = self.seen if self.last_ts else 0
+        self.resumed = not self.last_ts
+        self.offset = offset
+        self.limit = limit
+        self.lines = []
+
+    def since(self, start_time, tail):
+        if self.last_ts:
+            # docker only takes whole seconds, feed() skips what we already read
+            return self.last_ts // 10**9, 'all'
+        return start_time, tail or 'all'
+
+    def feed(self, line):
+        '''
+        take the next line, return True once the page is full
+        '''
+        if len(self.lines) >= self.limit:
+            return True
+        ts = parse_timestamp(line)
+        if not self.resumed:
+            if ts < self.last_ts:
+                return False
+            self.resumed = True
+        if self.replay:
+            self.replay -= 1
+            return False
+
+        if ts == self.last_ts:
+            self.seen += 1
+        else:
+            self.last_ts, self.seen = ts, 1
+        if self.offset:
+            self.offset -= 1
+            return False
+        self.lines.append(line)
+        return len(self.lines) >= self.limit
+
+    def result(self):
+        return {
+            'lines': self.lines,
+            'cursor': encode_cursor(self.last_ts, self.seen) if self.last_ts else self.cursor
+        }
+
+
+class RenderCache:
+    '''
+    rendered yaml by config content, yaml.dump is slow on mass rebuilds
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+RENDERED = RenderCache(4096)
+
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def write_config_file(path, content):
+    '''
+    write content unless the file already holds it, through a temp file
+    and a rename so a container never reads a partial config
+
+    return whether the file was written
+    '''
+    if file_digest(path) == hashlib.sha256(content).hexdigest():
+        return False
+    write_atomic(path, content, sync=True)
+    return True
+
+
 class NgrokConfig:
 
     def __init__(self, name, hostname, local_addr, remote_port, proto, auth):
-        # set by app.conf
-        self.server_addr = get_config('ngrok', 'server_addr')
-        self.trust_host_root_certs = True if get_config(
-            'ngrok', 'trust_host_root_certs').lower() in ("true", "1") else False
-        self.runtime_dir = get_config('ngrok', 'runtime_dir')
-        self.runtime_dir_in_container = get_config(
-            'ngrok', 'runtime_dir_in_container')
-        self.yaml_dirname = get_config('ngrok', 'yaml_dirname')
+        self.load_settings()
 
         self.name = name
+        self.hostname = hostname
+        self.proto = proto if proto else 'http'
+        self.remote_port = remote_port
 
         port_map = {}
         port_map['proto'] = dict([(
@@ -221,6 +505,19 @@ class NgrokConfig:
             port_map['hostname'] = hostname
         self.tunnels = {'server1': port_map}
 
+        self.set_paths()
+
+    def load_settings(self):
+        # set by app.conf
+        self.server_addr = get_config('ngrok', 'server_addr')
+        self.trust_host_root_certs = get_config_bool('ngrok', 'trust_host_root_certs')
+        self.runtime_dir = get_config('ngrok', 'runtime_dir')
+        self.runtime_dir_in_container = get_config(
+            'ngrok', 'runtime_dir_in_container')
+        self.yaml_dirname = get_config('ngrok', 'yaml_dirname')
+        self.stop_timeout = get_config_int('ngrok', 'stop_timeout', 10)
+
+    def set_paths(self):
         self.yaml_path = os.path.join(
             self.runtime_dir,
             self.yaml_dirname,
@@ -232,9 +529,32 @@ class NgrokConfig:
             self.name + '.yml'
         )
 
+    def packable(self):
+        '''
+        a tcp tunnel without remote port can not be told apart in a shared log
+        '''
+        return not (self.proto == 'tcp' and not self.remote_port)
+
+    def matches(self, url):
+        '''
+        whether an established url belongs to this tunnel
+        '''
+        parts = urlsplit(url)
+        if parts.scheme != self.proto:
+            return False
+        if self.proto == 'tcp':
+            return str(self.remote_port) == str(parts.port)
+        if self.hostname:
+            return parts.hostname == self.hostname.lower()
+        return (parts.hostname or '').startswith(self.name.lower() + '.')
+
     def dumps(self):
         data = self.dump()
-        yaml_str = yaml.dump(data, default_flow_style=False)
+        key = json.dumps(data, sort_keys=True)
+        yaml_str = RENDERED.get(key)
+        if yaml_str is None:
+            yaml_str = yaml.dump(data, default_flow_style=False)
+            RENDERED.set(key, yaml_str)
         return yaml_str
 
     def dump(self):
@@ -264,3 +584,33 @@ class NgrokConfig:
         ps = [9000]
         binds = ['{0}:{1}'.format(19000, 9000)]
         return ps, binds
+
+
+class NgrokPoolConfig(NgrokConfig):
+    '''
+    idle container of the warm pool, its config is written when claimed
+    '''
+
+    def __init__(self, name):
+        self.load_settings()
+
+        self.name = name
+        self.tunnels = {}
+
+        self.set_paths()
+
+
+class NgrokShardConfig(NgrokConfig):
+    '''
+    several tunnels served by one ngrok process
+    '''
+
+    def __init__(self, name, members):
+        self.load_settings()
+
+        self.name = name
+        self.tunnels = {}
+        for member in members:
+            self.tunnels[member.name] = member.tunnels['server1']
+
+        self.set_paths()
@@ -0,0 +1,51 @@
+import fcntl
+import threading
+
+
+class PeriodicTask:
+    '''
+    a pass run every interval seconds by a daemon thread, and by one
+    worker at a time through a file lock
+
+    subclasses implement work(), wakeup.set() runs the next pass right away
+    '''
+
+    # name of the thread, and what failure messages call the pass
+    name = 'ngrok-task'
+    title = 'task'
+
+    def __init__(self, interval, lock_path):
+        self.interval = interval
+        self.lock_path = lock_path
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.loop, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def loop(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.run()
+            except Exception as e:
+                print('{0} failed: {1}'.format(self.title, e))
+
+    def run(self):
+        '''
+        one pass, skipped when another worker is running one
+        '''
+        with open(self.lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+            return self.work()
+
+    def work(self):
+        raise NotImplementedError
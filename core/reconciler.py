@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+
+from core.atomicfile import write_atomic
+from core.periodic import PeriodicTask
+
+
+class Reconciler(PeriodicTask):
+    '''
+    periodically converge the tunnel table and the ngrok containers
+
+    - a running tunnel without container in two passes in a row is
+      recreated, a single pass may catch it being created
+    - a stopped container of a running tunnel is restarted, with the
+      backoff and budget of NgrokManager.restart_failed()
+    - a running container of a stopped tunnel is stopped
+    - a container without tunnel is removed
+    - tunnels without desired state are left alone
+    '''
+
+    name = 'ngrok-reconciler'
+    title = 'reconcile'
+
+    def __init__(self, manager, interval, lock_path='data/reconcile.lock',
+                 report_path='data/reconcile.json'):
+        super(Reconciler, self).__init__(interval, lock_path)
+        self.manager = manager
+        self.report_path = report_path
+
+    def work(self):
+        begin = time.time()
+        drift = self.diff()
+        self.correct(drift)
+        report = {
+            'time': int(begin),
+            'duration': time.time() - begin,
+            'drift': drift,
+            'pending': [d for d in drift if d.get('result') != 'ok']
+        }
+        self.save(report)
+        return report
+
+    def diff(self):
+        manager = self.manager
+        snapshot = manager.snapshot()
+
+        # a tunnel being created has a row but no container yet, only
+        # recreate what was already missing in the previous pass
+        previous = self.report() or {}
+        was_missing = set(d['container'] for d in previous.get('drift', [])
+                          if d.get('kind') == 'missing')
+        now = time.time()
+
+        drift = []
+        desired = manager.desired_containers()
+        for name, want in sorted(desired.items()):
+            container = snapshot.get(name)
+            state = container.get('State') if container else None
+            item = {'container': name, 'tunnel_ids': want['ids'], 'state': state}
+            if container is None:
+                item['kind'] = 'missing'
+                item['action'] = None
+                # nor what was (re)started since, it may still be coming up
+                recent = now - want['starttime'] < max(self.interval, manager.establish_deadline)
+                if want['running'] and name in was_missing and not recent:
+                    item['action'] = 'recreate'
+            elif want['running'] and state != 'running':
+                item['kind'] = 'not running'
+                item['action'] = 'restart'
+            elif want['managed'] and not want['running'] and state == 'running':
+                item['kind'] = 'not stopped'
+                item['action'] = 'stop'
+            else:
+                continue
+            drift.append(item)
+
+        for name, container in sorted(snapshot.items()):
+            if name.startswith('ngrok_') and name not in desired:
+                drift.append({
+                    'container': name,
+                    'tunnel_ids': [],
+                    'state': container.get('State'),
+                    'kind': 'orphan',
+                    'action': 'remove',
+                    'container_id': container.get('Id')
+                })
+        return drift
+
+    def correct(self, drift):
+        items = [d for d in drift if d.get('action')]
+        if not items:
+            return
+        with ThreadPoolExecutor(max_workers=self.manager.bulk_workers) as pool:
+            for item, result in zip(items, pool.map(self.act, items)):
+                item['result'] = result
+
+    def act(self, item):
+        manager = self.manager
+        action = item['action']
+        try:
+            if action == 'recreate':
+                manager.apply(item['tunnel_ids'][0])
+            elif action == 'restart':
+                result = manager.restart_failed(
+                    item['tunnel_ids'], 'container {0}'.format(item['state']))
+                # restarted now or later, either way it is taken care of
+                return 'ok' if result == 'restarted' else result
+            elif action == 'stop':
+                manager.stop(item['tunnel_ids'][0])
+            elif action == 'remove':
+                manager.docker_cli.remove_container(item['container_id'], force=True)
+            return 'ok'
+        except Exception as e:
+            return getattr(e, 'message', '') or str(e)
+
+    def save(self, report):
+        write_atomic(self.report_path, json.dumps(report))
+
+    def report(self):
+        try:
+            with open(self.report_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
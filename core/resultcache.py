@@ -0,0 +1,88 @@
+from functools import wraps
+import fcntl
+import json
+import os
+import threading
+import time
+
+from core.atomicfile import write_atomic
+
+
+class ResultCache:
+    '''
+    short lived results shared by all workers through files
+
+    concurrent misses of a key wait on a file lock for the one computing it,
+    any change bumps a generation which makes every stored result stale
+    '''
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.generation_path = os.path.join(path, 'generation')
+        if ttl > 0 and not os.path.exists(path):
+            os.makedirs(path)
+
+    def generation(self):
+        try:
+            with open(self.generation_path) as f:
+                return f.read()
+        except OSError:
+            return ''
+
+    def invalidate(self):
+        if self.ttl <= 0:
+            return
+        # unique even when threads of several workers invalidate at once
+        ident = '{0}.{1}'.format(os.getpid(), threading.get_ident())
+        write_atomic(self.generation_path, '{0}-{1}'.format(time.time(), ident))
+
+    def read(self, key, generation):
+        try:
+            with open(os.path.join(self.path, key + '.json')) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['generation'] != generation:
+            return None
+        if time.time() - entry['time'] > self.ttl:
+            return None
+        return entry
+
+    def write(self, key, generation, value):
+        write_atomic(os.path.join(self.path, key + '.json'), json.dumps(
+            {'generation': generation, 'time': time.time(), 'value': value}))
+
+    def get(self, key, compute):
+        if self.ttl <= 0:
+            return compute()
+
+        generation = self.generation()
+        entry = self.read(key, generation)
+        if entry:
+            return entry['value']
+
+        with open(os.path.join(self.path, key + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # computed by someone else while we waited
+            generation = self.generation()
+            entry = self.read(key, generation)
+            if entry:
+                return entry['value']
+            value = compute()
+            self.write(key, generation, value)
+            return value
+
+
+def invalidates(func):
+    '''
+    drop cached results before and after a method changing tunnels
+    '''
+    @wraps(func)
+    def wrapped(self, *args, **kwargs):
+        self.cache.invalidate()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.cache.invalidate()
+    return wrapped
@@ -0,0 +1,17 @@
+from core.periodic import PeriodicTask
+
+
+class Supervisor(PeriodicTask):
+    '''
+    restart crashed or disconnected tunnels, see NgrokManager.supervise()
+    '''
+
+    name = 'ngrok-supervisor'
+    title = 'supervise'
+
+    def __init__(self, manager, interval, lock_path='data/supervise.lock'):
+        super(Supervisor, self).__init__(interval, lock_path)
+        self.manager = manager
+
+    def work(self):
+        return self.manager.supervise()
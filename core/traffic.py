@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor
+import re
+import time
+
+from model import db, TunnelTraffic, TunnelLogCursor
+from core.ngrokwrapper import parse_timestamp
+from core.periodic import PeriodicTask
+
+
+# one bucket a minute over a day, the ring of a container never grows
+BUCKETS = 1440
+
+EVENTS = (
+    ('errors', re.compile(r'\[(WARN|EROR|CRIT)\]|Failed to open private leg')),
+    ('opened', re.compile(r'Joined with connection|New connection from')),
+    ('closed', re.compile(r'\bClosing\b')),
+)
+
+
+def parse_event(line):
+    '''
+    kind of connection event a log line is, None for other lines
+    '''
+    for kind, regex in EVENTS:
+        if regex.search(line):
+            return kind
+    return None
+
+
+class TrafficIngester(PeriodicTask):
+    '''
+    follow the log of every running ngrok container from a saved cursor
+    and count connection events into per-minute buckets
+    '''
+
+    name = 'ngrok-traffic'
+    title = 'traffic ingest'
+
+    def __init__(self, manager, interval, batch, lock_path='data/traffic.lock'):
+        super(TrafficIngester, self).__init__(interval, lock_path)
+        self.manager = manager
+        self.batch = batch
+
+    def work(self):
+        snapshot = self.manager.snapshot()
+        desired = self.manager.desired_containers()
+        cursors = dict((row.name, row) for row in TunnelLogCursor.select())
+
+        jobs = []
+        for name, want in desired.items():
+            container = snapshot.get(name)
+            if container is None or container.get('State') != 'running':
+                continue
+            cursor = cursors.get(name)
+            if cursor and cursor.container_id != container.get('Id'):
+                # a new container, its log starts over
+                cursor = None
+            jobs.append((name, want['ids'][0], container.get('Id'),
+                         cursor.cursor if cursor else None))
+
+        def read(job):
+            name, id, container_id, cursor = job
+            try:
+                tunnel_instance = self.manager.get_tunnel_instance_by_id(id)
+                return job, tunnel_instance.log(cursor=cursor, limit=self.batch)
+            except Exception as e:
+                print('traffic ingest of {0} failed: {1}'.format(name, e))
+                return job, None
+
+        results = []
+        if jobs:
+            with ThreadPoolExecutor(max_workers=self.manager.bulk_workers) as pool:
+                results = list(pool.map(read, jobs))
+
+        oldest = int(time.time()) // 60 - BUCKETS + 1
+        counts = {}
+        with db.atomic():
+            for (name, id, container_id, _), log in results:
+                if log is None:
+                    continue
+                for line in log['lines']:
+                    kind = parse_event(line)
+                    minute = parse_timestamp(line) // (60 * 10**9)
+                    if kind is None or minute < oldest:
+                        continue
+                    bucket = counts.setdefault((name, minute), {
+                        'opened': 0, 'closed': 0, 'errors': 0})
+                    bucket[kind] += 1
+                self.save_cursor(name, container_id, log['cursor'])
+
+            for (name, minute), bucket in counts.items():
+                self.add(name, minute, bucket)
+
+            # containers of removed tunnels
+            names = list(desired) or ['']
+            TunnelTraffic.delete().where(TunnelTraffic.name.not_in(names)).execute()
+            TunnelLogCursor.delete().where(TunnelLogCursor.name.not_in(names)).execute()
+        return len(counts)
+
+    def save_cursor(self, name, container_id, cursor):
+        updated = TunnelLogCursor.update(
+            container_id=container_id, cursor=cursor or ''
+        ).where(TunnelLogCursor.name == name).execute()
+        if not updated:
+            TunnelLogCursor.create(name=name, container_id=container_id, cursor=cursor or '')
+
+    def add(self, name, minute, bucket):
+        slot = minute % BUCKETS
+        row = TunnelTraffic.select().where(
+            (TunnelTraffic.name == name) & (TunnelTraffic.slot == slot)).first()
+        if row is None:
+            TunnelTraffic.create(name=name, slot=slot, minute=minute, **bucket)
+        elif row.minute == minute:
+            TunnelTraffic.update(
+                opened=TunnelTraffic.opened + bucket['opened'],
+                closed=TunnelTraffic.closed + bucket['closed'],
+                errors=TunnelTraffic.errors + bucket['errors']
+            ).where(TunnelTraffic.id == row.id).execute()
+        elif row.minute < minute:
+            # the slot still holds a minute of yesterday
+            TunnelTraffic.update(minute=minute, **bucket).where(
+                TunnelTraffic.id == row.id).execute()
+
+    @staticmethod
+    def stats(name, minutes):
+        '''
+        buckets of the last minutes, oldest first, with their totals
+        '''
+        now = int(time.time()) // 60
+        rows = TunnelTraffic.select().where(
+            (TunnelTraffic.name == name) &
+            (TunnelTraffic.minute > now - minutes)
+        ).order_by(TunnelTraffic.minute)
+
+        buckets = []
+        total = {'opened': 0, 'closed': 0, 'errors': 0}
+        for row in rows:
+            buckets.append({
+                'time': row.minute * 60,
+                'opened': row.opened,
+                'closed': row.closed,
+                'errors': row.errors
+            })
+            for key in total:
+                total[key] += getattr(row, key)
+        return {'minutes': minutes, 'total': total, 'buckets': buckets}
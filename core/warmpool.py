@@ -0,0 +1,69 @@
+from docker.errors import APIError
+import uuid
+
+from core.ngrokwrapper import NgrokPoolConfig
+from core.periodic import PeriodicTask
+
+
+class WarmPool(PeriodicTask):
+    '''
+    idle ngrok containers created ahead of time, claimed by renaming them
+    '''
+
+    prefix = 'ngrokpool_'
+    label = 'ngrok.pool_yaml'
+    name = 'ngrok-warm-pool'
+    title = 'warm pool refill'
+
+    def __init__(self, docker_cli, size, image='alpine:3.4',
+                 refill_interval=5, lock_path='data/warmpool.lock'):
+        super(WarmPool, self).__init__(refill_interval, lock_path)
+        self.cli = docker_cli
+        self.size = size
+        self.image = image
+
+    def start(self):
+        # fill the pool right away, then every refill interval or claim
+        self.wakeup.set()
+        super(WarmPool, self).start()
+
+    def idle(self):
+        res = self.cli.containers(all=True, filters={'name': self.prefix})
+        return [c for c in res if c.get('State') == 'created']
+
+    def work(self):
+        # one worker refills at a time, the others would overshoot
+        for i in range(self.size - len(self.idle())):
+            self.create()
+
+    def create(self):
+        config = NgrokPoolConfig(self.prefix + uuid.uuid4().hex[:12])
+        volumes = config.volumes()
+        container = self.cli.create_container(
+            name=config.name,
+            image=self.image,
+            command=config.command(),
+            volumes=volumes[0],
+            labels={self.label: config.name + '.yml'},
+            host_config=self.cli.create_host_config(
+                binds=volumes[1]
+            )
+        )
+        return container.get('Id')
+
+    def claim(self, name):
+        '''
+        give an idle container the name of a tunnel container,
+        return its id and the config file name it reads, or None
+        '''
+        for container in self.idle():
+            try:
+                # fails when another worker claimed it first
+                self.cli.rename(container.get('Id'), name)
+            except APIError:
+                continue
+            self.wakeup.set()
+            labels = container.get('Labels') or {}
+            return container.get('Id'), labels.get(self.label)
+        self.wakeup.set()
+        return None
@@ -2,8 +2,38 @@ from peewee import *
 import json
 import string
 import random
+import time
 
-db = SqliteDatabase('data/database.db')
+from config import get_config_float
+
+
+class TimedSqliteDatabase(SqliteDatabase):
+    '''
+    report the duration of every query to the observers
+    '''
+
+    observers = []
+
+    def execute_sql(self, sql, *args, **kwargs):
+        begin = time.time()
+        try:
+            return super(TimedSqliteDatabase, self).execute_sql(sql, *args, **kwargs)
+        finally:
+            seconds = time.time() - begin
+            for observer in self.observers:
+                observer(sql, seconds)
+
+
+# wal lets readers in other workers go on while one of them writes,
+# busy timeout makes writers wait for the lock instead of failing
+db = TimedSqliteDatabase(
+    'data/database.db',
+    pragmas=(
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal'),
+        ('busy_timeout', int(get_config_float('basic', 'db_busy_timeout', 10) * 1000)),
+    ),
+    timeout=get_config_float('basic', 'db_busy_timeout', 10))
 
 
 class Tunnel(Model):
@@ -19,6 +49,102 @@ class Tunnel(Model):
         database = db
 
 
+class TunnelMapping(Model):
+    # parsed "Tunnel established at" result of one container start
+    tunnel_id = IntegerField()
+    container_id = CharField()
+    starttime = IntegerField()
+    url = CharField()
+    proto = CharField()
+    addr = CharField()
+    port = CharField()
+
+    class Meta:
+        database = db
+        indexes = (
+            (('tunnel_id', 'container_id', 'starttime'), True),
+            # load_mappings() looks rows up by container alone
+            (('container_id',), False),
+        )
+
+
+class TunnelState(Model):
+    # desired state of a tunnel and how restoring it went
+    tunnel_id = IntegerField(unique=True)
+    desired = CharField(default='running')
+    failures = IntegerField(default=0)
+    restarts = IntegerField(default=0)
+    last_failure = CharField(default='')
+    next_attempt = FloatField(default=0)
+
+    class Meta:
+        database = db
+
+
+class TunnelAttempt(Model):
+    # one start of a tunnel and when it got established
+    tunnel_id = IntegerField()
+    starttime = IntegerField()
+    started_at = FloatField()
+    established_at = FloatField(null=True)
+    latency = FloatField(null=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('tunnel_id', 'starttime'), False),
+        )
+
+
+class TunnelTraffic(Model):
+    # connection events of a container in one minute, see core/traffic.py
+    name = CharField()
+    slot = IntegerField()
+    minute = IntegerField()
+    opened = IntegerField(default=0)
+    closed = IntegerField(default=0)
+    errors = IntegerField(default=0)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('name', 'slot'), True),
+        )
+
+
+class TunnelLogCursor(Model):
+    # how far the traffic ingester has read the log of a container
+    name = CharField(unique=True)
+    container_id = CharField()
+    cursor = CharField(default='')
+
+    class Meta:
+        database = db
+
+
+class Job(Model):
+    # background work on a tunnel, see core/jobs.py
+    uuid = CharField(unique=True)
+    tunnel_id = IntegerField(index=True)
+    state = CharField()
+    url = CharField(default='')
+    msg = CharField(default='')
+    done = BooleanField(default=False)
+    created = IntegerField()
+    updated = IntegerField()
+
+    class Meta:
+        database = db
+
+
+class SchemaVersion(Model):
+    # number of MIGRATIONS applied to this database
+    version = IntegerField()
+
+    class Meta:
+        database = db
+
+
 class Auth(Model):
     token = CharField()
 
@@ -45,11 +171,119 @@ def tunnel_to_dict(row):
     return d
 
 
+def mapping_to_dict(row):
+    d = {}
+    d['url'] = row.url
+    d['proto'] = row.proto
+    d['addr'] = row.addr
+    d['port'] = row.port
+    return d
+
+
+def state_to_dict(row):
+    d = {}
+    # no row, not managed yet, see NgrokManager.desired_containers()
+    d['desired'] = row.desired if row else None
+    d['restarts'] = row.restarts if row else 0
+    d['failures'] = row.failures if row else 0
+    d['last_failure'] = row.last_failure if row else ''
+    return d
+
+
+def attempt_to_dict(row):
+    d = {}
+    d['tunnel_id'] = row.tunnel_id
+    d['started_at'] = row.started_at
+    d['established_at'] = row.established_at
+    d['latency'] = row.latency
+    return d
+
+
+def job_to_dict(row):
+    d = {}
+    d['id'] = row.uuid
+    d['tunnel_id'] = row.tunnel_id
+    d['state'] = row.state
+    d['url'] = row.url
+    d['msg'] = row.msg
+    d['done'] = row.done
+    d['created'] = row.created
+    d['updated'] = row.updated
+    return d
+
+
+def add_index(model, columns, unique=False):
+    table = model._meta.db_table
+    db.execute_sql('CREATE {0}INDEX IF NOT EXISTS "{1}" ON "{2}" ({3})'.format(
+        'UNIQUE ' if unique else '',
+        '_'.join([table] + list(columns)),
+        table,
+        ', '.join('"{0}"'.format(column) for column in columns)))
+
+
+def migration_1():
+    # indexes of tables created before they were declared
+    add_index(Tunnel, ['name'], unique=True)
+    add_index(TunnelMapping, ['tunnel_id', 'container_id', 'starttime'], unique=True)
+    add_index(TunnelMapping, ['container_id'])
+    add_index(TunnelState, ['tunnel_id'], unique=True)
+    add_index(TunnelAttempt, ['tunnel_id', 'starttime'])
+    add_index(Job, ['uuid'], unique=True)
+    add_index(Job, ['tunnel_id'])
+
+
+# append only, every migration must also work on a freshly created table
+MIGRATIONS = [
+    migration_1,
+]
+
+
+def database_migrate():
+    with db.atomic():
+        row = SchemaVersion.select().first()
+        if row is None:
+            row = SchemaVersion.create(version=0)
+        for version in range(row.version, len(MIGRATIONS)):
+            MIGRATIONS[version]()
+            print("schema migrated to version {0}".format(version + 1))
+        if row.version != len(MIGRATIONS):
+            row.version = len(MIGRATIONS)
+            row.save()
+
+
 def database_init():
     try:
         Tunnel.create_table()
     except OperationalError:
         print("tunnel table already exists!")
+    try:
+        TunnelMapping.create_table()
+    except OperationalError:
+        print("tunnel mapping table already exists!")
+    try:
+        TunnelState.create_table()
+    except OperationalError:
+        print("tunnel state table already exists!")
+    try:
+        TunnelAttempt.create_table()
+    except OperationalError:
+        print("tunnel attempt table already exists!")
+    try:
+        TunnelTraffic.create_table()
+    except OperationalError:
+        print("tunnel traffic table already exists!")
+    try:
+        TunnelLogCursor.create_table()
+    except OperationalError:
+        print("tunnel log cursor table already exists!")
+    try:
+        Job.create_table()
+    except OperationalError:
+        print("job table already exists!")
+    try:
+        SchemaVersion.create_table()
+    except OperationalError:
+        print("schema version table already exists!")
     try:
         Auth.create_table()
         random_token = Auth.token_gen(32)
@@ -57,4 +291,4 @@ def database_init():
         print("auth token: " + random_token)
     except OperationalError:
         print("auth table already exists!")
-
+    database_migrate()
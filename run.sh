@@ -1 +1 @@
-gunicorn view:app -b 0.0.0.0:5000 --reload
\ No newline at end of file
+gunicorn view:application -b 0.0.0.0:5000 --threads 16 --reload
\ No newline at end of file
@@ -0,0 +1 @@
+uvicorn asgi:app --host 0.0.0.0 --port 5000
@@ -1,15 +1,29 @@
 from pycnic.core import WSGI, Handler
+from urllib.parse import parse_qs
 import json
+import re
+import time
 import yaml
 
-from model import database_init
-from auth import requires_auth, change_auth
-from config import get_config
-from core.ngrokmanager import NgrokManager
+from model import db, database_init
+from auth import requires_auth, change_auth, verify_token
+from config import get_config, get_config_int, install_reload_signal
+from core.ngrokmanager import NgrokManager, tunnels_from_yaml, tunnels_to_yaml
+from core.metrics import Metrics
 from core.error import TunnelInstanceError, TunnelManagerError
 
 
 NM = NgrokManager(get_config('basic', 'docker_url'))
+install_reload_signal()
+
+METRICS = Metrics(get_config('basic', 'metrics_dir', 'data/metrics'))
+NM.docker_cli.observers.append(
+    lambda method, seconds: METRICS.observe(
+        'ngrok_webapi_docker_call_duration_seconds', {'method': method}, seconds))
+db.observers.append(
+    lambda sql, seconds: METRICS.observe(
+        'ngrok_webapi_sqlite_query_duration_seconds',
+        {'statement': sql.split(' ', 1)[0].upper()}, seconds))
 
 
 class Info(Handler):
@@ -57,7 +71,23 @@ class Tunnels(Handler):
     @requires_auth()
     def post(self):
         try:
+            if self.request.data.get('async'):
+                res = NM.create_async(self.request.data)
+                return {'data': res, 'error': 0}
+            wait = get_wait(self.request)
             res = NM.create(self.request.data)
+            if wait:
+                return wait_response(res['id'], wait)
+            return {'data': res, 'error': 0}
+        except TunnelManagerError as e:
+            return {'data': None, 'error': 1, 'msg': e.message}
+
+    @requires_auth()
+    def patch(self):
+        action = self.request.data.get('action', '')
+        ids = self.request.data.get('ids')
+        try:
+            res = NM.bulk(action, ids)
             return {'data': res, 'error': 0}
         except TunnelManagerError as e:
             return {'data': None, 'error': 1, 'msg': e.message}
@@ -68,6 +98,41 @@ class Tunnels(Handler):
         return {'data': res, 'error': 0}
 
 
+class TunnelBatch(Handler):
+
+    def options(self):
+        set_options(self)
+        return ''
+
+    @requires_auth()
+    def get(self):
+        res = NM.export()
+        if self.request.args.get('format') == 'yaml':
+            self.response.set_header('Content-Type', 'application/x-yaml')
+            return yaml.safe_dump(tunnels_to_yaml(res), default_flow_style=False)
+        return {'data': res, 'error': 0}
+
+    @requires_auth()
+    def post(self):
+        try:
+            content_type = self.request.environ.get('CONTENT_TYPE', '')
+            if 'yaml' in content_type or self.request.args.get('format') == 'yaml':
+                try:
+                    tunnel_dicts = tunnels_from_yaml(yaml.safe_load(self.request.body))
+                except yaml.YAMLError:
+                    raise TunnelManagerError(None, 'invalid yaml')
+            else:
+                data = self.request.data
+                tunnel_dicts = data.get('tunnels') if isinstance(data, dict) else data
+                if isinstance(tunnel_dicts, dict):
+                    # {"tunnels": {...}} as in doc/demo.yml
+                    tunnel_dicts = tunnels_from_yaml(data)
+            res = NM.create_batch(tunnel_dicts)
+            return {'data': res, 'error': 0}
+        except TunnelManagerError as e:
+            return {'data': None, 'error': 1, 'msg': e.message}
+
+
 class Tunnel(Handler):
 
     def options(self, id):
@@ -96,6 +161,7 @@ class Tunnel(Handler):
 
         msg, result = '', ''
         try:
+            wait = get_wait(self.request)
             # if no action, default to update
             if action == '':
                 result = NM.update(id, self.request.data)
@@ -105,6 +171,8 @@ class Tunnel(Handler):
                 result = NM.stop(id)
             elif action == 'rebuild':
                 result = NM.rebuild(id)
+            if wait and action in ('start', 'rebuild'):
+                return wait_response(id, wait)
         except TunnelManagerError as e:
             msg = e.message
 
@@ -119,11 +187,16 @@ class TunnelLog(Handler):
     @requires_auth()
     def get(self, id):
         try:
+            cursor = self.request.args.get('cursor', '')
             offset = int(self.request.args.get('offset', 0))
             limit = int(self.request.args.get('limit', 10))
-            tunnel = NM.get_tunnel_instance_by_id(id)
-            result = tunnel.log(offset=offset, limit=limit)
+            limit = min(limit, get_config_int('basic', 'log_max_limit', 5000))
+            tail = self.request.args.get('tail', '')
+            tail = int(tail) if tail else None
+            result = NM.log(id, cursor=cursor, offset=offset, limit=limit, tail=tail)
             return {'data': result, 'error': 0}
+        except ValueError:
+            return {'data': None, 'error': 1, 'msg': 'offset, limit and tail must be integers'}
         except TunnelManagerError as e:
             return {'data': None, 'error': 1, 'msg': e.message}
 
@@ -133,8 +206,7 @@ class TunnelStatus(Handler):
     @requires_auth()
     def get(self, id):
         try:
-            tunnel = NM.get_tunnel_instance_by_id(id)
-            result = tunnel.status()
+            result = NM.status(id)
             if result:
                 return {'data': result, 'error': 0}
             return {'data': result, 'error': 1, 'msg': 'tunnel does not running'}
@@ -142,9 +214,90 @@ class TunnelStatus(Handler):
             return {'data': None, 'error': 1, 'msg': e.message}
 
 
+class TunnelStats(Handler):
+
+    @requires_auth()
+    def get(self, id):
+        try:
+            minutes = int(self.request.args.get('minutes', 60))
+            return {'data': NM.stats(id, minutes), 'error': 0}
+        except ValueError:
+            return {'data': None, 'error': 1, 'msg': 'minutes must be an integer'}
+        except TunnelManagerError as e:
+            return {'data': None, 'error': 1, 'msg': e.message}
+
+
+class TunnelReadiness(Handler):
+
+    @requires_auth()
+    def get(self, id):
+        return {'data': NM.readiness(id), 'error': 0}
+
+
+class Readiness(Handler):
+
+    @requires_auth()
+    def get(self):
+        return {'data': NM.readiness(), 'error': 0}
+
+
+class Reconcile(Handler):
+
+    @requires_auth()
+    def get(self):
+        return {'data': NM.reconcile_report(), 'error': 0}
+
+    @requires_auth()
+    def post(self):
+        try:
+            return {'data': NM.reconcile(), 'error': 0}
+        except TunnelManagerError as e:
+            return {'data': None, 'error': 1, 'msg': e.message}
+
+
+class Job(Handler):
+
+    @requires_auth()
+    def get(self, id):
+        try:
+            result = NM.get_job(id)
+            return {'data': result, 'error': 0}
+        except TunnelManagerError as e:
+            return {'data': None, 'error': 1, 'msg': e.message}
+
+
+def get_wait(request):
+    '''
+    seconds to wait for the tunnel to be established, 0 for no wait
+    '''
+    wait = request.data.get('wait') or request.args.get('wait') or 0
+    try:
+        wait = float(wait)
+    except ValueError:
+        raise TunnelManagerError(None, 'wait must be a number')
+    return max(0, min(wait, get_config_int('basic', 'max_wait', 120)))
+
+def wait_response(id, wait):
+    result, lines = NM.wait(id, wait)
+    if lines is None:
+        return {'data': result, 'error': 0}
+    return {
+        'data': result,
+        'error': 1,
+        'msg': 'tunnel not established in {0}s'.format(wait),
+        'log': lines
+    }
+
 def after(handler):
     handler.response.set_header('Access-Control-Allow-Origin', '*')
 
+def route_of(path):
+    # the route pattern, raw paths would give a label per tunnel id
+    for pattern, _ in app.routes:
+        if re.match('^' + pattern + '$', path):
+            return pattern
+    return 'unknown'
+
 def set_options(handler):
     handler.response.set_header('Access-Control-Allow-Methods', 'GET,POST,PATCH,DELETE')
     handler.response.set_header('Access-Control-Allow-Headers', 'Content-Type')
@@ -158,9 +311,156 @@ class app(WSGI):
         ("/info", Info()),
         ("/token", Token()),
         ("/api/tunnels", Tunnels()),
+        ("/api/tunnels/batch", TunnelBatch()),
         ("/api/tunnels/([\w]+)", Tunnel()),
         ("/api/tunnels/([\w]+)/log", TunnelLog()),
-        ("/api/tunnels/([\w]+)/status", TunnelStatus())
+        ("/api/tunnels/([\w]+)/status", TunnelStatus()),
+        ("/api/tunnels/([\w]+)/readiness", TunnelReadiness()),
+        ("/api/tunnels/([\w]+)/stats", TunnelStats()),
+        ("/api/readiness", Readiness()),
+        ("/api/jobs/([\w]+)", Job()),
+        ("/api/reconcile", Reconcile())
     ]
 
     database_init()
+
+
+def request_app():
+    '''
+    pycnic keeps one handler per route and sets request and response on it,
+    give every request its own handlers so concurrent threads do not see
+    each other's request
+    '''
+    routes = [(pattern, type(handler)()) for pattern, handler in app.routes]
+    return type('app', (app,), {'routes': routes})
+
+
+def stream_ids(args):
+    '''
+    tunnel ids of /api/tunnels/stream?ids=1,2,3
+    '''
+    ids = []
+    for value in args.get('ids', []):
+        for id in value.split(','):
+            if id.strip() and id.strip() not in ids:
+                ids.append(id.strip())
+    return ids
+
+
+def tunnel_stream(environ, start_response, id=None):
+    '''
+    server-sent events (or json lines with format=jsonl) for one tunnel,
+    or for the tunnels of ?ids= when id is None
+
+    every open stream holds a thread of the worker until the client leaves
+    '''
+    args = parse_qs(environ.get('QUERY_STRING', ''))
+    token = args.get('token', [''])[0]
+    fmt = args.get('format', ['sse'])[0]
+
+    def error(msg, code):
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Access-Control-Allow-Origin', '*')
+        ])
+        return [json.dumps({'data': None, 'error': code, 'msg': msg}).encode()]
+
+    if not verify_token(token):
+        return error('401 Not Authorized', 401)
+    try:
+        if id is None:
+            ids = stream_ids(args)
+            if not ids:
+                return error('need ids', 1)
+            events = NM.stream_many(ids)
+        else:
+            events = NM.stream(id)
+        first = next(events)
+    except TunnelManagerError as e:
+        return error(e.message, 1)
+
+    if fmt == 'jsonl':
+        content_type = 'application/x-ndjson'
+    else:
+        content_type = 'text/event-stream'
+    start_response('200 OK', [
+        ('Content-Type', content_type),
+        ('Cache-Control', 'no-cache'),
+        ('X-Accel-Buffering', 'no'),
+        ('Access-Control-Allow-Origin', '*')
+    ])
+
+    def body():
+        try:
+            yield format_event(fmt, *first)
+            for event, data in events:
+                yield format_event(fmt, event, data)
+        finally:
+            events.close()
+    return body()
+
+
+def format_event(fmt, event, data):
+    if fmt == 'jsonl':
+        return (json.dumps({'event': event, 'data': data}) + '\n').encode()
+    if event == 'heartbeat':
+        return b': heartbeat\n\n'
+    return 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data)).encode()
+
+
+def metrics(environ, start_response):
+    args = parse_qs(environ.get('QUERY_STRING', ''))
+    if not verify_token(args.get('token', [''])[0]):
+        start_response('401 Unauthorized', [('Content-Type', 'text/plain')])
+        return [b'401 Not Authorized\n']
+
+    gauges = []
+    for state, count in NM.count_by_state().items():
+        gauges.append(('ngrok_webapi_tunnels', {'state': state or 'none'}, count))
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+    return [METRICS.render(gauges).encode()]
+
+
+def application(environ, start_response):
+    '''
+    entry point, streams bypass pycnic which only sends whole bodies
+    '''
+    path = environ.get('PATH_INFO', '')
+    if path == '/metrics' and environ.get('REQUEST_METHOD') == 'GET':
+        return metrics(environ, start_response)
+    matched = re.match(r'^/api/tunnels/([\w]+)/stream$', path)
+    if matched and environ.get('REQUEST_METHOD') == 'GET':
+        return tunnel_stream(environ, start_response, matched.group(1))
+    if path == '/api/tunnels/stream' and environ.get('REQUEST_METHOD') == 'GET':
+        return tunnel_stream(environ, start_response)
+    return timed(environ, start_response)
+
+
+def timed(environ, start_response):
+    '''
+    run the pycnic app and count the request with the status it really
+    sent, pycnic skips the after hook on errors
+    '''
+    begin = time.time()
+    sent = {'code': '500'}
+    if db.is_closed():
+        db.connect()
+
+    def timed_start_response(status, headers, exc_info=None):
+        sent['code'] = status.split(' ', 1)[0]
+        return start_response(status, headers, exc_info)
+
+    try:
+        # pycnic builds the whole body while being iterated
+        return list(request_app()(environ, timed_start_response))
+    finally:
+        # pycnic skips the after hook on errors, close here
+        if not db.is_closed():
+            db.close()
+        labels = {
+            'route': route_of(environ.get('PATH_INFO', '')),
+            'method': environ.get('REQUEST_METHOD', '')
+        }
+        METRICS.observe('ngrok_webapi_request_duration_seconds', labels, time.time() - begin)
+        labels['code'] = sent['code']
+        METRICS.inc('ngrok_webapi_requests_total', labels)